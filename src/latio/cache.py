@@ -0,0 +1,41 @@
+import os
+
+
+def get_cache_dir(*parts):
+    """
+    Returns a latio cache directory, creating it if needed.
+    Uses LATIO_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/latio or ~/.cache/latio.
+    """
+    root = os.environ.get('LATIO_CACHE_DIR')
+    if not root:
+        xdg_cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(xdg_cache, 'latio')
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_cached(*parts):
+    """
+    Returns the cached text stored under the given path parts, or None if it isn't cached.
+    """
+    path = os.path.join(get_cache_dir(*parts[:-1]), parts[-1])
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def write_cached(text, *parts):
+    """
+    Stores text under the given path parts. Writes to a temporary file first so readers never see a partial entry.
+    """
+    path = os.path.join(get_cache_dir(*parts[:-1]), parts[-1])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: could not write cache entry {path}: {e}")
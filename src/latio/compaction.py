@@ -0,0 +1,210 @@
+import os
+import re
+try:
+    from . import tokens
+except ImportError:
+    import tokens
+
+# Line comment and block comment markers per file extension, used to find license headers and banners
+comment_styles = {
+    'hash': {'line': ['#'], 'block': []},
+    'c': {'line': ['//'], 'block': [('/*', '*/')]},
+    'dash': {'line': ['--'], 'block': []},
+    'markup': {'line': [], 'block': [('<!--', '-->')]},
+}
+
+extension_styles = {
+    '.py': 'hash', '.sh': 'hash', '.bash': 'hash', '.rb': 'hash', '.pl': 'hash', '.r': 'hash',
+    '.yml': 'hash', '.yaml': 'hash', '.toml': 'hash', '.tf': 'hash', '.cfg': 'hash', '.ini': 'hash',
+    '.js': 'c', '.jsx': 'c', '.ts': 'c', '.tsx': 'c', '.mjs': 'c', '.cjs': 'c', '.go': 'c', '.java': 'c',
+    '.kt': 'c', '.scala': 'c', '.c': 'c', '.h': 'c', '.cc': 'c', '.cpp': 'c', '.hpp': 'c', '.cs': 'c',
+    '.rs': 'c', '.swift': 'c', '.php': 'c', '.dart': 'c', '.css': 'c', '.scss': 'c',
+    '.sql': 'dash', '.lua': 'dash', '.hs': 'dash',
+    '.html': 'markup', '.htm': 'markup', '.xml': 'markup', '.vue': 'markup', '.svg': 'markup',
+}
+
+filename_styles = {
+    'Dockerfile': 'hash',
+    'Makefile': 'hash',
+    'Gemfile': 'hash',
+    'Rakefile': 'hash',
+}
+
+license_markers = re.compile(r'(copyright|licen[cs]e|spdx-license-identifier|all rights reserved)', re.IGNORECASE)
+
+# A banner line is a comment made only of repeated punctuation, like "# ========" or "/* ****** */"
+banner_line = re.compile(r'^\s*(#|//|--|/\*|\*|<!--)?\s*([=\-*#/~_+]{10,})\s*(\*/|-->)?\s*$')
+
+# Long runs of base64 are encoded assets, keys or fixtures that the model can't usefully read
+base64_run = re.compile(r'[A-Za-z0-9+/]{200,}={0,2}')
+
+rules = ['license_header', 'comment_banner', 'trailing_whitespace', 'blank_lines', 'base64']
+
+
+def get_comment_style(file_path):
+    """
+    Returns the comment style for a file, or None if the language isn't recognised.
+    """
+    name = os.path.basename(file_path)
+    if name in filename_styles:
+        return comment_styles[filename_styles[name]]
+    style = extension_styles.get(os.path.splitext(name)[1].lower())
+    return comment_styles[style] if style else None
+
+
+def _is_comment(line, style):
+    """
+    Returns True if the line is a line comment or part of a block comment in the given style.
+    """
+    stripped = line.strip()
+    if any(stripped.startswith(marker) for marker in style['line']):
+        return True
+    for start, end in style['block']:
+        if stripped.startswith(start) or stripped.endswith(end):
+            return True
+    # Continuation lines of C style block comments start with *
+    return bool(style['block']) and stripped.startswith('*')
+
+
+def _license_header_span(lines, style):
+    """
+    Returns the (start, end) indexes of a leading license comment block, or (0, 0) if the file doesn't start with one.
+    """
+    start = 0
+    # Keep shebangs and encoding declarations, they change how the file runs
+    while start < len(lines) and (lines[start].startswith('#!') or (lines[start].startswith('#') and 'coding' in lines[start][:30])):
+        start += 1
+    end = start
+    while end < len(lines) and lines[end].strip() and _is_comment(lines[end], style):
+        end += 1
+    if end > start and license_markers.search('\n'.join(lines[start:end])):
+        return start, end
+    return 0, 0
+
+
+def compact_source(file_path, content):
+    """
+    Returns (compacted, line_map, saved) for a file's content.
+    line_map[i] is the original 1-based line number of compacted line i + 1, with None for the markers
+    left where lines were removed. saved maps each rule to the tokens it removed, net of the markers it added.
+    Removed license headers leave a marker with the removed range, and the line after collapsed blank lines is
+    prefixed with its original number, like "57: def f():", so every line's original number can be counted from
+    the nearest marker above it.
+    """
+    lines = content.splitlines()
+    style = get_comment_style(file_path)
+    # Counted in characters while compacting and converted to tokens at the end, so small per-line savings add up
+    saved = new_savings()
+    removed = [None] * len(lines)
+
+    if style:
+        header_start, header_end = _license_header_span(lines, style)
+        for i in range(header_start, header_end):
+            removed[i] = 'license_header'
+        # Banners become blank lines rather than markers, which keeps the line numbers around them intact
+        for i, line in enumerate(lines):
+            if removed[i] is None and banner_line.match(line):
+                saved['comment_banner'] += len(line)
+                lines[i] = ''
+
+    # Collapse runs of blank lines down to one
+    previous_blank = False
+    for i, line in enumerate(lines):
+        if removed[i]:
+            continue
+        blank = not line.strip()
+        if blank and previous_blank:
+            removed[i] = 'blank_lines'
+        previous_blank = blank
+
+    output = []
+    line_map = []
+    renumber = False
+    i = 0
+    while i < len(lines):
+        rule = removed[i]
+        if rule:
+            start = i
+            while i < len(lines) and removed[i] == rule:
+                i += 1
+            chars = sum(len(line) + 1 for line in lines[start:i])
+            if rule == 'blank_lines':
+                # The next line is renumbered, so only collapse runs that save more than the number costs
+                cost = len(f"{i + 1}: ") if i < len(lines) else 0
+                if chars <= cost:
+                    for j in range(start, i):
+                        removed[j] = None
+                    i = start
+                    continue
+                saved[rule] += chars - cost
+                renumber = True
+            else:
+                marker = f"[lines {start + 1}-{i}: {rule.replace('_', ' ')} removed]"
+                saved[rule] += chars - len(marker) - 1
+                output.append(marker)
+                line_map.append(None)
+            continue
+
+        line = lines[i]
+        stripped = line.rstrip()
+        if stripped != line:
+            saved['trailing_whitespace'] += len(line) - len(stripped)
+            line = stripped
+
+        def replace_base64(match):
+            placeholder = f"<base64 {len(match.group(0))} chars>"
+            saved['base64'] += len(match.group(0)) - len(placeholder)
+            return placeholder
+        line = base64_run.sub(replace_base64, line)
+
+        if renumber:
+            line = f"{i + 1}: {line}"
+            renumber = False
+        output.append(line)
+        line_map.append(i + 1)
+        i += 1
+
+    saved = {rule: tokens.tokens_for_chars(max(chars, 0)) for rule, chars in saved.items()}
+    return '\n'.join(output), line_map, saved
+
+
+def original_line(line_map, compacted_line):
+    """
+    Returns the original line number for a 1-based line number in compacted output, or None for a removal marker.
+    """
+    if 1 <= compacted_line <= len(line_map):
+        return line_map[compacted_line - 1]
+    return None
+
+
+def number_lines(content, line_map=None):
+    """
+    Returns content with every line prefixed by its line number, like "8: def f():", for structured findings on
+    files that weren't compacted. Compacted files already carry their original numbers where lines were removed.
+    """
+    return '\n'.join(f"{number}: {line}" for number, line in enumerate(content.splitlines(), 1))
+
+
+def new_savings():
+    """
+    Returns an empty per-rule savings counter.
+    """
+    return {rule: 0 for rule in rules}
+
+
+def add_savings(total, saved):
+    """
+    Adds the savings from one file to a running per-rule total.
+    """
+    for rule, count in saved.items():
+        total[rule] += count
+    return total
+
+
+def format_savings(saved):
+    """
+    Returns a one line summary of the tokens saved by each rule.
+    """
+    total = sum(saved.values())
+    details = ", ".join(f"{rule}: {count}" for rule, count in saved.items() if count)
+    return f"Compaction saved ~{total} tokens" + (f" ({details})" if details else "")
@@ -13,10 +13,40 @@ import google.generativeai as genai
 from IPython.display import display
 from IPython.display import Markdown
 import asyncio
+import atexit
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 try:
     from . import workers
+    from . import filetypes
+    from . import sharding
+    from . import cache
+    from . import tokens
+    from . import compaction
+    from . import prompts
+    from . import planner
+    from . import retrieval
+    from . import depgraph
+    from . import watcher
+    from . import findings
+    from . import gitindex
 except ImportError:
     import workers
+    import filetypes
+    import sharding
+    import cache
+    import tokens
+    import compaction
+    import prompts
+    import planner
+    import retrieval
+    import depgraph
+    import watcher
+    import findings
+    import gitindex
 
 def to_markdown(text):
     text = text.replace('•', '  *')
@@ -24,6 +54,10 @@ def to_markdown(text):
 
 google_models = ['gemini-pro']
 
+# Structured findings repeat the file, lines and rule for every issue, so they need more room than a prose review
+REVIEW_MAX_TOKENS = 1000
+FINDINGS_MAX_TOKENS = 4096
+
 client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
 githubkey = os.environ.get('GITHUB_TOKEN')
 googleapikey = os.environ.get('GEMINI_API_KEY')
@@ -98,328 +132,487 @@ def get_changed_files(directory):
         if 'original_dir' in locals():
             os.chdir(original_dir)
 
-def get_line_changes(directory, changed_files):
+def parse_diff_hunks(diff_text):
+    """
+    Returns the hunks of a unified diff as a list of {"header", "lines"} dicts, dropping the git file headers.
+    """
+    hunks = []
+    for line in diff_text.splitlines():
+        if line.startswith('@@'):
+            hunks.append({"header": line, "lines": []})
+        elif hunks and not line.startswith('\\'):
+            hunks[-1]["lines"].append(line)
+    return hunks
+
+def get_file_diffs(directory, changed_files):
     """
-    Returns a string containing colored line changes from the changed files.
+    Returns a list of uncolored file diffs, each a {"file", "status", "hunks"} dict.
+    Status is "modified" for git diffs, "new" for untracked files and "full" when no diff was available.
     """
     original_dir = os.getcwd()
-    line_changes = ""
+    file_diffs = []
     try:
         os.chdir(directory)
         print(f"Getting line changes in {os.getcwd()}")
-        
+
+        try:
+            untracked_files = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard"], text=True).strip().split('\n')
+        except subprocess.CalledProcessError as e:
+            print(f"Error checking untracked files: {e}")
+            untracked_files = []
+
         for file in changed_files:
             print(f"Processing file: {file}")
             
             # Track if we've found changes for this file
             found_changes = False
             
-            # Try unstaged changes first
-            try:
-                result = subprocess.check_output(["git", "diff", "--", file], text=True)
-                if result.strip():
-                    print(f"Found unstaged changes for {file}")
-                    line_changes += f"\nFile: {color_text(file, '34')}\n" 
-                    for line in result.splitlines():
-                        line_changes += color_diff_line(line) + "\n"
-                    found_changes = True
-            except subprocess.CalledProcessError as e:
-                print(f"Error getting unstaged diff for {file}: {e}")
-            
-            # If no unstaged changes, try staged changes
-            if not found_changes:
+            # Try unstaged changes first, then staged changes
+            for label, command in (("unstaged", ["git", "diff", "--", file]), ("staged", ["git", "diff", "--staged", "--", file])):
                 try:
-                    result = subprocess.check_output(["git", "diff", "--staged", "--", file], text=True)
+                    result = subprocess.check_output(command, text=True)
                     if result.strip():
-                        print(f"Found staged changes for {file}")
-                        line_changes += f"\nFile: {color_text(file, '34')}\n" 
-                        for line in result.splitlines():
-                            line_changes += color_diff_line(line) + "\n"
+                        print(f"Found {label} changes for {file}")
+                        file_diffs.append({"file": file, "status": "modified", "hunks": parse_diff_hunks(result)})
                         found_changes = True
+                        break
                 except subprocess.CalledProcessError as e:
-                    print(f"Error getting staged diff for {file}: {e}")
+                    print(f"Error getting {label} diff for {file}: {e}")
             
             # Check if this is an untracked file (new file)
-            if not found_changes:
+            if not found_changes and file in untracked_files:
+                print(f"{file} is an untracked file, including full content")
                 try:
-                    untracked_files = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard"], text=True).strip().split('\n')
-                    if file in untracked_files:
-                        print(f"{file} is an untracked file, including full content")
-                        try:
-                            with open(file, 'r') as f:
-                                content = f.read()
-                            
-                            # Format as a diff for a new file
-                            line_changes += f"\nFile: {color_text(file, '34')} (New File)\n"
-                            line_changes += f"diff --git a/{file} b/{file}\n"
-                            line_changes += f"new file mode 100644\n"
-                            line_changes += f"--- /dev/null\n"
-                            line_changes += f"+++ b/{file}\n"
-                            
-                            # Add each line with a + to indicate addition
-                            for line in content.splitlines():
-                                line_changes += color_diff_line("+" + line) + "\n"
-                                
-                            found_changes = True
-                        except Exception as e:
-                            print(f"Error reading untracked file {file}: {e}")
-                except subprocess.CalledProcessError as e:
-                    print(f"Error checking untracked files: {e}")
+                    content = filetypes.read_text_file(file)
+                    if content is None:
+                        continue
+                    lines = content.splitlines()
+                    # Format as a single all-added hunk, the same as git shows a new file
+                    header = f"@@ -0,0 +1,{len(lines)} @@"
+                    file_diffs.append({"file": file, "status": "new", "hunks": [{"header": header, "lines": ["+" + line for line in lines]}]})
+                    found_changes = True
+                except Exception as e:
+                    print(f"Error reading untracked file {file}: {e}")
             
             # If still no changes found, this is unexpected
             if not found_changes:
                 print(f"Warning: No changes found for {file} despite it being in the changed files list")
                 try:
-                    with open(file, 'r') as f:
-                        content = f.read()
-                    line_changes += f"\nFile: {color_text(file, '34')} (Full content - no diff available)\n"
-                    for line in content.splitlines():
-                        line_changes += line + "\n"
+                    content = filetypes.read_text_file(file)
+                    if content is None:
+                        continue
+                    file_diffs.append({"file": file, "status": "full", "hunks": [{"header": None, "lines": content.splitlines()}]})
                 except Exception as e:
                     print(f"Error reading file {file}: {e}")
     
     except Exception as e:
-        print(f"Unexpected error in get_line_changes: {e}")
+        print(f"Unexpected error in get_file_diffs: {e}")
         import traceback
         traceback.print_exc()
     finally:
         os.chdir(original_dir)
         
-    if not line_changes.strip():
+    if not file_diffs:
         print("Warning: No line changes were detected for any files")
         
-    return line_changes
+    return file_diffs
+
+diff_status_labels = {
+    "modified": "",
+    "new": " (New File)",
+    "full": " (Full content - no diff available)",
+}
 
-def full_sec_scan(application_summary, model):
+def format_file_diffs(file_diffs, colored=False):
     """
-    This function sends a code snippet to OpenAI's API to check for security vulnerabilities.
+    Returns the file diffs as text. The model payload uses the plain form, colored=True is only for printing to the terminal.
     """
-    if model in google_models:
-        try:
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content("You are an application security expert, skilled in explaining complex programming vulnerabilities with simplicity. You will receive the full code for an application. Your task is to review the code for security vulnerabilities and suggest improvements. Don't overly focus on one file, and instead provide the top security concerns based on what you think the entire application is doing. Here is the code: " + application_summary)
-            message = to_markdown(response.text)
-            return message
-        except Exception as e:
-            return f"Error occurred: {e}"
+    output = ""
+    for file_diff in file_diffs:
+        file_name = color_text(file_diff["file"], '34') if colored else file_diff["file"]
+        output += f"\nFile: {file_name}{diff_status_labels[file_diff['status']]}\n"
+        for hunk in file_diff["hunks"]:
+            if hunk["header"]:
+                output += (color_text(hunk["header"], '36') if colored else hunk["header"]) + "\n"
+            for line in hunk["lines"]:
+                output += (color_diff_line(line) if colored and file_diff["status"] != "full" else line) + "\n"
+    return output
+
+def get_line_changes(directory, changed_files):
+    """
+    Returns a string containing the uncolored line changes from the changed files.
+    """
+    return format_file_diffs(get_file_diffs(directory, changed_files))
+
+def usage_counts(usage):
+    """
+    Returns (prompt_tokens, cached_tokens) from an OpenAI or Gemini usage object, or None if there is no usage.
+    """
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    if prompt_tokens is None:
+        # Gemini reports usage under different names
+        prompt_tokens = getattr(usage, 'prompt_token_count', None)
+        if prompt_tokens is None:
+            return None
+        cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
     else:
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are an application security expert."},
-                    {"role": "user", "content": "Please review the following code for security vulnerabilities: " + application_summary}
-                ],
-                max_tokens=1000,
-                temperature=0.7,
-            )
-            message = response.choices[0].message.content.strip()
-            return message
-        except Exception as e:
-            return f"Error occurred: {e}"
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    return prompt_tokens, cached_tokens
 
-def full_health_scan(application_summary, model):
+def report_cache_usage(usage):
     """
-    This function sends a code snippet to OpenAI's API to check for optimizations.
+    Prints prompt tokens and how many of them were served from the provider's prompt cache.
     """
+    counts = usage_counts(usage)
+    if counts:
+        print(f"Prompt tokens: {counts[0]} ({counts[1]} cached)")
+
+def run_review(task, application_summary, model, repo_context="", structured=False, timeout=None):
+    """
+    Sends code to the model for review using the shared stable-prefix prompt layout from prompts.py.
+    With structured, or when findings are streamed, the model is asked for JSON findings, in JSON mode for OpenAI
+    models, and the response is returned without markdown quoting. Streamed findings are emitted as soon as the
+    response arrives. timeout limits an OpenAI request to that many seconds, without retries, so a scan with a
+    deadline isn't held past it by one slow request.
+    """
+    structured = structured or findings.active()
+    if structured:
+        task += prompts.findings_format
     if model in google_models:
         try:
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content("You are a world class 10x developer who gives kind suggestions for remediating code smells and optimizing for big O complexity. You will receive the full code for an application. Your task is to review the code for optimizations and improvements, calling out the major bottlenecks. Don't overly focus on one file, and instead provide the best optimizations based on what you think the entire application is doing. Here is the code: " + application_summary)
-            message = to_markdown(response.text)
+            gemini = genai.GenerativeModel(model)
+            response = gemini.generate_content(prompts.build_prompt(task, application_summary, repo_context))
+            report_cache_usage(getattr(response, 'usage_metadata', None))
+            # Structured responses are returned as the raw JSON, quoting every line would stop them parsing
+            message = response.text if structured else to_markdown(response.text)
+            findings.emit(response.text, model)
             return message
         except Exception as e:
             return f"Error occurred: {e}"
     else:
         try:
-            response = client.chat.completions.create(
+            requester = client if timeout is None else client.with_options(timeout=timeout, max_retries=0)
+            response = requester.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": "You are a world class 10x developer."},
-                    {"role": "user", "content": "Please review the following code for optimizations: " + application_summary}
-                ],
-                max_tokens=1000,
+                messages=prompts.build_messages(task, application_summary, repo_context),
+                max_tokens=FINDINGS_MAX_TOKENS if structured else REVIEW_MAX_TOKENS,
                 temperature=0.7,
+                **({"response_format": {"type": "json_object"}} if structured else {}),
             )
+            report_cache_usage(getattr(response, 'usage', None))
             message = response.choices[0].message.content.strip()
+            findings.emit(message, model)
             return message
         except Exception as e:
             return f"Error occurred: {e}"
 
-def full_scan(directory, model, health=False):
+def report_agent_cache_usage(result):
     """
-    Scans all files in the specified directory holistically for security issues.
+    Prints input tokens summed over every model call in an agent run, and returns them.
+    Prompt cache hits are only printed when the agents SDK reports them: the Usage in openai-agents 0.0.7, the
+    version pinned in requirements.txt, has input_tokens but no input_tokens_details.
+    """
+    input_tokens = 0
+    cached_tokens = None
+    for response in getattr(result, 'raw_responses', []):
+        usage = getattr(response, 'usage', None)
+        input_tokens += getattr(usage, 'input_tokens', 0) or 0
+        details = getattr(usage, 'input_tokens_details', None)
+        if details is not None:
+            cached_tokens = (cached_tokens or 0) + (getattr(details, 'cached_tokens', 0) or 0)
+    if cached_tokens is None:
+        print(f"Agent input tokens: {input_tokens} (cache hits not reported by this agents SDK)")
+    else:
+        print(f"Agent input tokens: {input_tokens} ({cached_tokens} cached)")
+    return input_tokens
+
+def full_sec_scan(application_summary, model, repo_context="", timeout=None):
+    """
+    This function sends a code snippet to OpenAI's API to check for security vulnerabilities.
+    """
+    return run_review(prompts.full_security_task, application_summary, model, repo_context, timeout=timeout)
+
+def full_health_scan(application_summary, model, repo_context="", timeout=None):
+    """
+    This function sends a code snippet to OpenAI's API to check for optimizations.
+    """
+    return run_review(prompts.full_health_task, application_summary, model, repo_context, timeout=timeout)
+
+# Common patterns to ignore
+ignore_patterns = {
+    'directories': [
+        'node_modules',
+        '.git',
+        '__pycache__',
+        '.pytest_cache',
+        'dist',
+        'build',
+        'venv',
+        '.venv',
+        'env',
+        '.env',
+        'target',
+        'out',
+        'coverage',
+        '.next',
+        '.nuxt',
+        '.output',
+        '.cache',
+        '.idea',
+        '.vscode',
+        '.DS_Store',
+        '.gradle'
+    ],
+    'files': [
+        '*.pyc',
+        '*.pyo',
+        '*.pyd',
+        '*.so',
+        '*.dll',
+        '*.dylib',
+        '*.exe',
+        '*.class',
+        '*.jar',
+        '*.war',
+        '*.ear',
+        '*.zip',
+        '*.tar.gz',
+        '*.tar',
+        '*.gz',
+        '*.rar',
+        '*.7z',
+        '*.pdf',
+        '*.doc',
+        '*.docx',
+        '*.xls',
+        '*.xlsx',
+        '*.ppt',
+        '*.pptx',
+        '*.jpg',
+        '*.jpeg',
+        '*.png',
+        '*.gif',
+        '*.ico',
+        '*.svg',
+        '*.woff',
+        '*.woff2',
+        '*.ttf',
+        '*.eot',
+        '*.mp3',
+        '*.mp4',
+        '*.wav',
+        '*.ogg',
+        '*.webm',
+        '*.mov',
+        '*.avi',
+        '*.mkv',
+        '*.log',
+        '*.lock',
+        '*.min.js',
+        '*.min.css',
+        '*.bundle.js',
+        '*.bundle.css'
+    ]
+}
+
+def should_ignore(path):
+    """
+    Returns True if the path is in an ignored directory or matches an ignored file pattern.
     """
-    application_summary = ""
+    # Check if path contains any ignored directory
+    for pattern in ignore_patterns['directories']:
+        if pattern in path.split(os.sep):
+            return True
+
+    # Check if file matches any ignored pattern
+    for pattern in ignore_patterns['files']:
+        if path.endswith(pattern.replace('*', '')):
+            return True
+
+    return False
+
+
+def list_scan_files(directory, ignore=False):
+    """
+    Returns every file path under the directory in a stable order, skipping ignored paths when ignore is set.
+    """
+    file_paths = []
     for root, dirs, files in os.walk(directory):
-        for file in files:
+        if ignore:
+            # Remove ignored directories from dirs to prevent walking into them
+            dirs[:] = [d for d in dirs if not should_ignore(os.path.join(root, d))]
+        dirs.sort()
+        for file in sorted(files):
             file_path = os.path.join(root, file)
-            try:
-                with open(file_path, 'r') as f:
-                    application_summary += f"\n\nFile: {file}\n"
-                    application_summary += f.read()
-            except UnicodeDecodeError:
-                    try:
-                        with open(file_path, 'r', encoding='latin-1') as f:
-                            application_summary += f"\n\nFile: {file}\n"
-                            application_summary += f.read()
-                    except Exception as e:
-                        print(f"Error reading {file_path}: {e}")
-    if health:
-        result = full_health_scan(application_summary, model)
+            if ignore and should_ignore(file_path):
+                continue
+            file_paths.append(file_path)
+    return file_paths
+
+def list_shard_files(directory):
+    """
+    Returns the inventory a sharded scan splits: the files git tracks, or every file outside ignored paths when the
+    directory isn't a repository, without binaries and generated files. Machine-local files such as .git/ or
+    node_modules never enter it, so every runner with the same checkout assigns files to the same shards.
+    """
+    tracked = gitindex.git(directory, "ls-files", "-z")
+    if tracked is None:
+        files = list_scan_files(directory, ignore=True)
     else:
-        result = full_sec_scan(application_summary, model)
-    return result
+        files = sorted(os.path.join(directory, path) for path in os.fsdecode(tracked).split('\0') if path)
+        # Submodules are listed as paths but aren't files
+        files = [f for f in files if not should_ignore(f) and os.path.isfile(f)]
+    return [f for f in files if not filetypes.should_skip_file(f)]
 
-async def full_agent_scan(directory, model, health=False):
+def full_scan(directory, model, health=False, files=None, compact=False, triage_model=None, threshold=5, deadline=None, max_tokens=None):
     """
-    Scans files changed locally and includes detailed line changes for security issues.
+    Scans all files in the specified directory holistically for security issues.
+    Pass files to scan only part of the directory, such as a single shard.
+    With compact, license headers, banners, whitespace and base64 blobs are stripped before sending, and lines
+    after removed ones keep their original line number.
+    With triage_model, each file is triaged first and only risky files are sent to the main model.
+    With a deadline in seconds or max_tokens, files are scanned in batches, changed and high-risk files first,
+    and no new batch is started once the budget would be exceeded. A coverage report is appended to the result.
     """
-    # Common patterns to ignore
-    ignore_patterns = {
-        'directories': [
-            'node_modules',
-            '.git',
-            '__pycache__',
-            '.pytest_cache',
-            'dist',
-            'build',
-            'venv',
-            '.venv',
-            'env',
-            '.env',
-            'target',
-            'out',
-            'coverage',
-            '.next',
-            '.nuxt',
-            '.output',
-            '.cache',
-            '.idea',
-            '.vscode',
-            '.DS_Store',
-            '.gradle'
-        ],
-        'files': [
-            '*.pyc',
-            '*.pyo',
-            '*.pyd',
-            '*.so',
-            '*.dll',
-            '*.dylib',
-            '*.exe',
-            '*.class',
-            '*.jar',
-            '*.war',
-            '*.ear',
-            '*.zip',
-            '*.tar.gz',
-            '*.tar',
-            '*.gz',
-            '*.rar',
-            '*.7z',
-            '*.pdf',
-            '*.doc',
-            '*.docx',
-            '*.xls',
-            '*.xlsx',
-            '*.ppt',
-            '*.pptx',
-            '*.jpg',
-            '*.jpeg',
-            '*.png',
-            '*.gif',
-            '*.ico',
-            '*.svg',
-            '*.woff',
-            '*.woff2',
-            '*.ttf',
-            '*.eot',
-            '*.mp3',
-            '*.mp4',
-            '*.wav',
-            '*.ogg',
-            '*.webm',
-            '*.mov',
-            '*.avi',
-            '*.mkv',
-            '*.log',
-            '*.lock',
-            '*.min.js',
-            '*.min.css',
-            '*.bundle.js',
-            '*.bundle.css'
-        ]
-    }
-
-    def should_ignore(path):
-        # Check if path contains any ignored directory
-        for pattern in ignore_patterns['directories']:
-            if pattern in path.split(os.sep):
-                return True
-        
-        # Check if file matches any ignored pattern
-        for pattern in ignore_patterns['files']:
-            if path.endswith(pattern.replace('*', '')):
-                return True
-        
-        return False
+    if files is None:
+        files = list_scan_files(directory)
+    deep_scan = full_health_scan if health else full_sec_scan
+    repo_context = prompts.repository_context(directory)
+
+    def scan_files(file_paths, timeout=None):
+        chunks = []
+        savings = compaction.new_savings()
+        for file_path in file_paths:
+            content = filetypes.read_text_file(file_path)
+            if content is not None:
+                if compact:
+                    content, _, saved = compaction.compact_source(file_path, content)
+                    compaction.add_savings(savings, saved)
+                elif findings.active():
+                    # Structured findings need line numbers, as in gather_full_code
+                    content = compaction.number_lines(content)
+                chunks.append((file_path, f"\n\nFile: {os.path.relpath(file_path, directory)}\n" + content))
+        if compact:
+            print(compaction.format_savings(savings))
+        payload_tokens = sum(tokens.estimate_tokens(text) for _, text in chunks)
+        if triage_model:
+            return cascade_scan(chunks, model, triage_model, threshold, deep_scan, health, repo_context=repo_context, timeout=timeout), payload_tokens
+        application_summary = "".join(text for _, text in chunks)
+        return deep_scan(application_summary, model, repo_context, timeout=timeout), payload_tokens
+
+    if deadline is None and max_tokens is None:
+        result, _ = scan_files(files)
+        return result
 
+    # Cascades time a triage pass plus a deep review, so they keep their own timing history
+    budget = planner.new_budget(deadline, max_tokens, mode="full-cascade" if triage_model else "full")
+    # Binaries and generated files are dropped up front so they don't count against the budget
+    files = [f for f in files if not filetypes.should_skip_file(f)]
+    ordered = planner.prioritize_files(directory, files, get_changed_files(directory))
+    results = []
+    for batch_files, batch_tokens in planner.plan_batches(ordered):
+        reason = planner.should_stop(budget, model, batch_tokens)
+        if reason:
+            planner.skip_files(budget, batch_files, reason)
+            continue
+        start = time.monotonic()
+        # Requests are cut off at the deadline rather than left to run past it
+        result, payload_tokens = scan_files(batch_files, planner.remaining_seconds(budget))
+        # run_review reports failures, timeouts included, as text rather than raising
+        if result.startswith("Error occurred:"):
+            remaining = planner.remaining_seconds(budget)
+            if remaining is not None and remaining <= 0:
+                planner.skip_files(budget, batch_files, "deadline was reached while a request was running")
+            else:
+                planner.skip_files(budget, batch_files, f"request failed: {result}")
+            continue
+        planner.record_request(budget, model, batch_files, batch_tokens, time.monotonic() - start, payload_tokens)
+        results.append(result)
+    return "\n\n".join(results) + "\n\n" + planner.coverage_report(budget, directory)
+
+async def run_full_agent(directory, files):
+    """
+    Runs the full context agents over a list of files and returns (output, input_tokens).
+    """
     file_list = []
     total_chars = 0
-    for root, dirs, files in os.walk(directory):
-        # Remove ignored directories from dirs to prevent walking into them
-        dirs[:] = [d for d in dirs if not should_ignore(os.path.join(root, d))]
-        
-        for file in files:
-            file_path = os.path.join(root, file)
-            if should_ignore(file_path):
-                continue
-                
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    char_count = len(content)
-                file_list.append(f"{file_path} ({char_count} chars)")
-                total_chars += char_count
-            except UnicodeDecodeError:
-                # Try with a different encoding if UTF-8 fails
-                try:
-                    with open(file_path, 'r', encoding='latin-1') as f:
-                        content = f.read()
-                        char_count = len(content)
-                    file_list.append(f"{file_path} ({char_count} chars)")
-                    total_chars += char_count
-                except Exception as e:
-                    file_list.append(f"{file_path} (error reading file: {str(e)})")
-            except Exception as e:
-                file_list.append(f"{file_path} (error reading file: {str(e)})")
+    for file_path in files:
+        # The size on disk is a close enough character count for the file parser
+        try:
+            char_count = os.path.getsize(file_path)
+            file_list.append(f"{file_path} ({char_count} chars)")
+            total_chars += char_count
+        except Exception as e:
+            file_list.append(f"{file_path} (error reading file: {str(e)})")
     
     application_summary = f"Total characters: {total_chars}\n\nFiles:\n" + "\n".join(file_list)
 
-    prompt = "Here are all of the files in this application: " + application_summary
+    # Repository context goes first so every agent run on this commit starts with the same prefix
+    prompt = prompts.repository_context(directory) + "\nHere are all of the files in this application: " + application_summary
+    if findings.active():
+        prompt += "\n" + prompts.findings_format
+    print("Sending to context agent...")
+    security_tool = workers.security_agent.as_tool(
+        tool_name="security_agent",
+        tool_description="Specialist in evaluating code for security issues."
+    ) 
+    health_tool = workers.health_agent.as_tool(
+        tool_name="health_agent",
+        tool_description="Specialist in evaluating code for health issues."
+    )
+    full_context_code_gatherer = workers.full_context_agent_code.as_tool(
+        tool_name="full_context_agent_code",
+        tool_description="Specialist in evaluating code for security and health issues."
+    )
+    full_context_with_tools = workers.full_context_file_parser.clone(tools=[full_context_code_gatherer, security_tool, health_tool, workers.gather_full_code])
+    result = await Runner.run(full_context_with_tools, prompt)
+    input_tokens = report_agent_cache_usage(result)
+    print("Received response from full context agent")
+    findings.emit(result.final_output)
+    return result.final_output, input_tokens
+
+async def full_agent_scan(directory, model, health=False, files=None, deadline=None, max_tokens=None):
+    """
+    Scans files changed locally and includes detailed line changes for security issues.
+    Pass files to scan only part of the directory, such as a single shard.
+    With a deadline in seconds or max_tokens, files are scanned in batches, changed and high-risk files first,
+    and no new batch is started once the budget would be exceeded. A coverage report is appended to the result.
+    """
+    if files is None:
+        files = list_scan_files(directory, ignore=True)
+    # Binaries and generated files are dropped before they are read
+    files = [f for f in files if not filetypes.should_skip_file(f)]
+
     try:
-        # Try with proper error handling
-        print("Sending to context agent...")
-        security_tool = workers.security_agent.as_tool(
-            tool_name="security_agent",
-            tool_description="Specialist in evaluating code for security issues."
-        ) 
-        health_tool = workers.health_agent.as_tool(
-            tool_name="health_agent",
-            tool_description="Specialist in evaluating code for health issues."
-        )
-        full_context_code_gatherer = workers.full_context_agent_code.as_tool(
-            tool_name="full_context_agent_code",
-            tool_description="Specialist in evaluating code for security and health issues."
-        )
-        full_context_with_tools = workers.full_context_file_parser.clone(tools=[full_context_code_gatherer, security_tool, health_tool, workers.gather_full_code])
-        result = await Runner.run(full_context_with_tools, prompt)
-        result = result.final_output
+        if deadline is None and max_tokens is None:
+            result, _ = await run_full_agent(directory, files)
+            return result
 
-        print("Received response from full context agent")
-                
-        return result
+        budget = planner.new_budget(deadline, max_tokens, mode="full-agentic")
+        ordered = planner.prioritize_files(directory, files, get_changed_files(directory))
+        results = []
+        for batch_files, batch_tokens in planner.plan_batches(ordered):
+            reason = planner.should_stop(budget, model, batch_tokens)
+            if reason:
+                planner.skip_files(budget, batch_files, reason)
+                continue
+            start = time.monotonic()
+            try:
+                result, input_tokens = await asyncio.wait_for(run_full_agent(directory, batch_files), timeout=planner.remaining_seconds(budget))
+            except asyncio.TimeoutError:
+                planner.skip_files(budget, batch_files, "deadline was reached while a request was running")
+                continue
+            except Exception as e:
+                # A failed batch is reported as not scanned, the batches before and after it still count
+                print(f"Error in context agent: {e}")
+                planner.skip_files(budget, batch_files, f"request failed: {e}")
+                continue
+            planner.record_request(budget, model, batch_files, batch_tokens, time.monotonic() - start, input_tokens or None)
+            results.append(result)
+        return "\n\n".join(results) + "\n\n" + planner.coverage_report(budget, directory)
     except Exception as e:
         print(f"Error in context agent: {e}")
         import traceback
@@ -427,121 +620,233 @@ async def full_agent_scan(directory, model, health=False):
         return color_text(f"Error during analysis: {str(e)}", "31")
 
 
-def partial_sec_scan(application_summary, model):
+def partial_sec_scan(application_summary, model, repo_context="", timeout=None):
     """
     This function sends a code snippet to OpenAI's API to check for security vulnerabilities.
     """
-    if model in google_models:
-        try:
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content("You are an application security expert, skilled in explaining complex programming vulnerabilities with simplicity. You will receive changed code as part of a pull request, followed by the rest of the file. Your task is to review the code change for security vulnerabilities and suggest improvements. Pay attention to if the code is getting added or removed indicated by the + or - at the beginning of the line. Suggest specific code fixes where applicable. Focus the most on the code that is being changed, which starts with Detailed Line Changes, instead of Changed Files. Here is the code: " + application_summary)
-            message = to_markdown(response.text)
-            return message
-        except Exception as e:
-            return f"Error occurred: {e}"
+    return run_review(prompts.partial_security_task, application_summary, model, repo_context, timeout=timeout)
+
+def partial_health_scan(application_summary, model, repo_context="", timeout=None):
+    """
+    This function sends a code snippet to OpenAI's API to check for code optimizations.
+    """
+    return run_review(prompts.partial_health_task, application_summary, model, repo_context, timeout=timeout)
+
+def triage_chunk(chunk, triage_model, health=False, timeout=None):
+    """
+    Returns (score, prompt_tokens) for a chunk of code: a 0-10 risk score from a small, fast model and the prompt
+    tokens the provider reported, or None if it didn't report any.
+    Any error scores 10, so a chunk is escalated to the deep review rather than silently dropped.
+    """
+    if health:
+        concern = "performance or maintainability problems"
+        system = "You are a senior software engineer triaging code for a performance and maintainability review."
     else:
-        try:
-            response = client.chat.completions.create(
-                model=model,
+        concern = "security vulnerabilities"
+        system = "You are an application security expert triaging code for review."
+    prompt = f"Rate from 0 to 10 how likely this code is to contain {concern} that deserve a detailed review. Reply with only the number. Here is the code: " + chunk
+    try:
+        if triage_model in google_models:
+            response = genai.GenerativeModel(triage_model).generate_content(system + "\n\n" + prompt)
+            text = response.text
+            counts = usage_counts(getattr(response, 'usage_metadata', None))
+        else:
+            requester = client if timeout is None else client.with_options(timeout=timeout, max_retries=0)
+            response = requester.chat.completions.create(
+                model=triage_model,
                 messages=[
-                    {"role": "system", "content": "You are an application security expert."},
-                    {"role": "user", "content": "Please review the following code changes for security vulnerabilities: " + application_summary}
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": prompt}
                 ],
-                max_tokens=1000,
-                temperature=0.7,
+                max_tokens=5,
+                temperature=0,
             )
-            message = response.choices[0].message.content.strip()
-            return message
-        except Exception as e:
-            return f"Error occurred: {e}"
+            text = response.choices[0].message.content
+            counts = usage_counts(getattr(response, 'usage', None))
+        match = re.search(r'\d+(\.\d+)?', text)
+        return (min(float(match.group(0)), 10.0) if match else 10.0), (counts[0] if counts else None)
+    except Exception as e:
+        print(f"Error triaging chunk, escalating it: {e}")
+        return 10.0, None
 
-def partial_health_scan(application_summary, model):
+def cascade_scan(chunks, model, triage_model, threshold, deep_scan, health=False, prefix="", suffix="", repo_context="", timeout=None):
     """
-    This function sends a code snippet to OpenAI's API to check for code optimizations.
+    Triages every (name, text) chunk with the triage model and sends only the chunks scoring at or
+    above the threshold to deep_scan with the main model. Prints latency, tokens and escalation rate per tier.
+    With timeout, both tiers together get that many seconds.
     """
-    if model in google_models:
-        try:
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content("You are a world class 10x developer who gives kind suggestions for remediating code smells and optimizing for big O complexity. You will receive changed code as part of a pull request, followed by the rest of the file. Your task is to review the changed code for optimizations and improvements, calling out any potential slowdowns. Pay attention to if the code is getting added or removed indicated by the + or - at the beginning of the line. Focus the most on the code that is being changed, which starts with Detailed Line Changes, instead of Changed Files. Here is the code: " + application_summary)
-            message = to_markdown(response.text)
-            return message
-        except Exception as e:
-            return f"Error occurred: {e}"
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        triaged = list(executor.map(lambda chunk: triage_chunk(chunk[1], triage_model, health, timeout), chunks))
+    triage_seconds = time.monotonic() - start
+    scores = [score for score, _ in triaged]
+    # Provider-reported prompt tokens, with an estimate only for responses that came back without usage
+    reported = [prompt_tokens for _, prompt_tokens in triaged if prompt_tokens is not None]
+    triage_tokens = sum(reported) + sum(tokens.estimate_tokens(text) for (_, text), (_, prompt_tokens) in zip(chunks, triaged) if prompt_tokens is None)
+    triage_label = "reported" if len(reported) == len(chunks) else f"{len(reported)} of {len(chunks)} reported, rest estimated"
+
+    escalated = []
+    for (name, text), score in zip(chunks, scores):
+        print(f"Triage {score:g}/10: {name}" + (" (escalated)" if score >= threshold else ""))
+        if score >= threshold:
+            escalated.append(text)
+
+    deep_seconds = 0.0
+    deep_tokens = 0
+    if escalated:
+        payload = prefix + "".join(escalated) + suffix
+        deep_tokens = tokens.estimate_tokens(payload)
+        deep_timeout = None if timeout is None else timeout - (time.monotonic() - start)
+        start = time.monotonic()
+        if deep_timeout is not None and deep_timeout <= 0:
+            result = "Error occurred: no time left for the deep review after triage"
+        else:
+            result = deep_scan(payload, model, repo_context, timeout=deep_timeout)
+        deep_seconds = time.monotonic() - start
     else:
+        result = f"Triage scored every chunk below {threshold:g}/10, nothing needed a deep review."
+
+    escalation_rate = len(escalated) / len(chunks) if chunks else 0.0
+    print(f"Triage tier ({triage_model}): {len(chunks)} chunks, {triage_seconds:.1f}s, {triage_tokens} input tokens ({triage_label})")
+    # The deep request prints its reported prompt tokens when it returns, this is the payload estimate
+    print(f"Deep tier ({model}): {len(escalated)} chunks, {deep_seconds:.1f}s, ~{deep_tokens} input tokens (estimated)")
+    print(f"Escalation rate: {escalation_rate:.0%}")
+    return result
+
+def fetch_github_blob(file, github_token):
+    """
+    Returns the full content of a pull request file, cached on disk by its blob SHA so each version is only downloaded once.
+    Returns None for binaries and generated files, which GitHub also sends without a patch.
+    """
+    cached = cache.read_cached('blobs', file.sha)
+    if cached is not None:
+        return cached
+    if cache.read_cached('blobs', f"{file.sha}.skipped") is not None:
+        return None
+    headers = {"Authorization": f"token {github_token}"} if github_token else {}
+    response = requests.get(file.raw_url, headers=headers)
+    if response.status_code != 200:
+        print(f"Failed to fetch {file.filename}")
+        return None
+    reason = filetypes.classify_content(file.filename, response.content)
+    if reason:
+        print(f"Skipping {file.filename} ({reason})")
+        # Remembered so the blob isn't downloaded again on the next scan of this pull request
+        cache.write_cached(reason, 'blobs', f"{file.sha}.skipped")
+        return None
+    try:
+        content = response.content.decode('utf-8')
+    except UnicodeDecodeError:
+        content = response.content.decode('latin-1')
+    cache.write_cached(content, 'blobs', file.sha)
+    return content
+
+def github_repository_context(repo, base_sha):
+    """
+    Returns the repository context block for a pull request's base commit, built from its tree and README through the
+    GitHub API the same way prompts.repository_context builds it from a checkout, and cached on disk per base commit.
+    """
+    cached = cache.read_cached('context', f"github-v{prompts.CONTEXT_VERSION}-{base_sha}")
+    if cached is not None:
+        return cached
+    try:
+        tree = repo.get_git_tree(base_sha, recursive=True).tree
+        tracked = [element.path for element in tree if element.type == 'blob']
+    except Exception as e:
+        print(f"Error fetching the base commit tree: {e}")
+        tracked = []
+    readme = prompts.find_readme(tracked)
+    readme_text = ""
+    if readme:
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a world class 10x developer."},
-                    {"role": "user", "content": "Please review the following code changes for optimizations: " + application_summary}
-                ],
-                max_tokens=1000,
-                temperature=0.7,
-            )
-            message = response.choices[0].message.content.strip()
-            return message
+            readme_text = repo.get_contents(readme, ref=base_sha).decoded_content.decode('utf-8', errors='replace')
         except Exception as e:
-            return f"Error occurred: {e}"
+            print(f"Error fetching {readme}: {e}")
+    context = prompts.format_repository_context(base_sha, tracked, readme, readme_text, repository=repo.full_name)
+    # A failed tree fetch isn't cached, so the next scan tries again
+    if tracked:
+        cache.write_cached(context, 'context', f"github-v{prompts.CONTEXT_VERSION}-{base_sha}")
+    return context
 
-def github_scan(repo_name, pr_number, github_token, model, health=False):
+def github_scan(repo_name, pr_number, github_token, model, health=False, full_files=False):
     """
     Scans files changed in the specified GitHub pull request holistically.
+    Sends the diff hunks GitHub already returns for each file, and only downloads the full file
+    when GitHub left the patch out because it was too large, or when full_files is set.
     """
-    g = Github(github_token)
+    # 100 files per page is the API maximum, so a 3,000 file pull request takes 30 requests instead of 100
+    g = Github(github_token, per_page=100)
     repo = g.get_repo(repo_name)
     pr = repo.get_pull(pr_number)
     files = pr.get_files()
 
-    changes_summary = ""
+    line_changes = ""
+    full_contents = ""
+    patch_count = 0
+    fetched_count = 0
     for file in files:
-        changes_summary += f"\n\nFile: {file.filename}\n"
-        url = file.raw_url
-        response = requests.get(url)
-        if response.status_code == 200:
-            changes_summary += response.text
-        else:
-            print(f"Failed to fetch {file.filename}")
+        if file.status == 'removed' or filetypes.classify_name(file.filename):
+            continue
+        # Pure renames have no patch and nothing to review
+        if file.status == 'renamed' and file.changes == 0:
+            continue
+        if file.patch and not full_files:
+            file_diff = {"file": file.filename, "status": "new" if file.status == 'added' else "modified", "hunks": parse_diff_hunks(file.patch)}
+            line_changes += format_file_diffs([file_diff])
+            patch_count += 1
+            continue
+        content = fetch_github_blob(file, github_token)
+        if content is not None:
+            full_contents += f"\n\nFile: {file.filename}\n"
+            full_contents += content
+            fetched_count += 1
+
+    print(f"Using patches for {patch_count} files, full content for {fetched_count} files")
+    changes_summary = ""
+    if line_changes:
+        changes_summary += "Detailed Line Changes:\n" + line_changes
+    if full_contents:
+        changes_summary += "\n\nChanged Files:" + full_contents
+    if not changes_summary:
+        return "No changed files to scan."
+    repo_context = github_repository_context(repo, pr.base.sha)
     if health:
-        result = partial_health_scan(changes_summary, model)
+        result = partial_health_scan(changes_summary, model, repo_context)
     else:
-        result = partial_sec_scan(changes_summary, model)
+        result = partial_sec_scan(changes_summary, model, repo_context)
     return result
 
-def partial_scan_github(directory, base_ref, head_ref, model, health=False):
+def partial_scan_github(directory, base_ref, head_ref, model, health=False, compact=False):
     """
     Scans files changed locally and includes detailed line changes for security issues.
+    With compact, the full file contents are compacted before sending, keeping their original line numbers where lines were removed,
+    the line changes are left as they are.
     """
-    changed_files = get_changed_files_github(directory, base_ref, head_ref)
+    # Built before get_changed_files_github changes into the directory
+    repo_context = prompts.repository_context(directory)
+    changed_files = [f for f in get_changed_files_github(directory, base_ref, head_ref) if f]
+    if not changed_files:
+        return "No changed files to scan."
     line_changes = get_line_changes(directory, changed_files)
     changes_summary = "Detailed Line Changes:\n" + line_changes + "\n\nChanged Files:\n"
 
+    savings = compaction.new_savings()
     for file_path in changed_files:
-        if file_path:
-            try:
-                with open(file_path, 'r') as f:
-                    changes_summary += f"\nFile: {file_path}\n"
-                    changes_summary += f.read()
-            except UnicodeDecodeError:
-                try:
-                    with open(file_path, 'r', encoding='latin-1') as f:
-                        changes_summary += f"\nFile: {file_path}\n"
-                        changes_summary += f.read()
-                except Exception as e:
-                    print(f"Error reading {file_path}: {e}")
-        else:
-            print("No changed files to scan.")
-            return
-        if changes_summary:
-            if health:
-                result = partial_health_scan(changes_summary, model)
-            else:
-                result = partial_sec_scan(changes_summary, model)
-            return result
-        else:
-            return "No changed files to scan."
-        return result
+        content = filetypes.read_text_file(file_path)
+        if content is not None:
+            if compact:
+                content, _, saved = compaction.compact_source(file_path, content)
+                compaction.add_savings(savings, saved)
+            changes_summary += f"\nFile: {file_path}\n"
+            changes_summary += content
+    if compact:
+        print(compaction.format_savings(savings))
+
+    if health:
+        result = partial_health_scan(changes_summary, model, repo_context)
     else:
-        return "No changed files to scan."
+        result = partial_sec_scan(changes_summary, model, repo_context)
+    return result
 
 def color_text(text, color_code):
     """
@@ -559,9 +864,26 @@ def color_diff_line(line):
         return color_text(line, "31") 
     return line
 
-async def partial_agent_scan(directory, model, health=False):
+def build_changes_summary(directory, file_diffs, changed_files, related_tokens, dependents_tokens):
+    """
+    Returns (changes_summary, context) for a partial review. The summary has the line changes, the changed files and
+    the context, which is up to related_tokens of related code and dependents_tokens of impacted call sites.
+    """
+    context = ""
+    related = retrieval.related_code(directory, file_diffs, related_tokens)
+    if related:
+        context += "\n\nRelated Code:\n" + related
+    impacted = depgraph.impacted_code(directory, file_diffs, dependents_tokens)
+    if impacted:
+        context += "\n\nImpacted Code:\n" + impacted
+    changes_summary = "Detailed Line Changes:\n" + format_file_diffs(file_diffs) + "\n\nChanged Files:\n" + "\n".join(changed_files) + context
+    return changes_summary, context
+
+async def partial_agent_scan(directory, model, health=False, related_tokens=retrieval.DEFAULT_RELATED_TOKENS, dependents_tokens=depgraph.DEFAULT_DEPENDENTS_TOKENS):
     """
     Scans files changed locally and includes detailed line changes for security issues.
+    Up to related_tokens of code related to the changed symbols is added from the local retrieval index,
+    and up to dependents_tokens of the call sites that use the changed functions from the dependency graph.
     """
     # Retrieve names of changed files
     changed_files = get_changed_files(directory)
@@ -574,18 +896,20 @@ async def partial_agent_scan(directory, model, health=False):
     for file_path in changed_files:
         print(color_text(file_path, "34"))
 
-    # Retrieve and print changed lines of code in green
-    line_changes = get_line_changes(directory, changed_files)
-    if not line_changes:
+    # Retrieve changed lines, colored only for the terminal
+    file_diffs = get_file_diffs(directory, changed_files)
+    if not file_diffs:
         return color_text("No changed lines to scan.", "31")  # Red text for errors
-    print(color_text("\nChanged Code for Analysis:\n", "32") + line_changes)  # Don't double-color the lines
+    print(color_text("\nChanged Code for Analysis:\n", "32") + format_file_diffs(file_diffs, colored=True))
 
     # Prepare the summary for scanning
-    changes_summary = "Detailed Line Changes:\n" + line_changes + "\n\nChanged Files:\n" + "\n".join(changed_files)
+    changes_summary, context = build_changes_summary(directory, file_diffs, changed_files, related_tokens, dependents_tokens)
     print("Starting partial scan...")
     
-    # Fix: Add space between prompt and content
-    prompt = "Please analyze these code changes: \n\n" + changes_summary
+    # Repository context goes first so every agent run on this commit starts with the same prefix
+    prompt = prompts.repository_context(directory) + "\nPlease analyze these code changes: \n\n" + changes_summary
+    if findings.active():
+        prompt += "\n" + prompts.findings_format
     
     try:
         # Try with proper error handling
@@ -600,8 +924,10 @@ async def partial_agent_scan(directory, model, health=False):
         )
         context_with_tools = workers.context_agent.clone(tools=[security_tool, health_tool, workers.analyze_code_context])
         result = await Runner.run(context_with_tools, prompt)
+        report_agent_cache_usage(result)
         result = result.final_output
         print("Received response from context agent")
+        findings.emit(result, model)
                 
         return result
     except Exception as e:
@@ -610,9 +936,12 @@ async def partial_agent_scan(directory, model, health=False):
         traceback.print_exc()
         return color_text(f"Error during analysis: {str(e)}", "31")
 
-def partial_scan(directory, model, health=False):
+def partial_scan(directory, model, health=False, triage_model=None, threshold=5, related_tokens=retrieval.DEFAULT_RELATED_TOKENS, dependents_tokens=depgraph.DEFAULT_DEPENDENTS_TOKENS):
     """
     Scans files changed locally and includes detailed line changes for security issues.
+    With triage_model, each file's changes are triaged first and only risky ones are sent to the main model.
+    Up to related_tokens of code related to the changed symbols is added from the local retrieval index,
+    and up to dependents_tokens of the call sites that use the changed functions from the dependency graph.
     """
     # Retrieve names of changed files
     changed_files = get_changed_files(directory)
@@ -624,22 +953,163 @@ def partial_scan(directory, model, health=False):
     for file_path in changed_files:
         print(color_text(file_path, "34"))
 
-    # Retrieve and print changed lines of code in green
-    line_changes = get_line_changes(directory, changed_files)
-    if not line_changes:
+    # Retrieve changed lines, colored only for the terminal
+    file_diffs = get_file_diffs(directory, changed_files)
+    if not file_diffs:
         return color_text("No changed lines to scan.", "31")  # Red text for errors
-    print(color_text("\nChanged Code for Analysis:\n", "32") + color_text(line_changes, "32"))  # Green text
+    print(color_text("\nChanged Code for Analysis:\n", "32") + format_file_diffs(file_diffs, colored=True))
 
     # Prepare the summary for scanning
-    changes_summary = "Detailed Line Changes:\n" + line_changes + "\n\nChanged Files:\n" + "\n".join(changed_files)
+    changes_summary, context = build_changes_summary(directory, file_diffs, changed_files, related_tokens, dependents_tokens)
+    print(f"Payload size: ~{tokens.estimate_tokens(changes_summary)} tokens")
+
+    repo_context = prompts.repository_context(directory)
+    if triage_model:
+        chunks = [(file_diff["file"], format_file_diffs([file_diff])) for file_diff in file_diffs]
+        deep_scan = partial_health_scan if health else partial_sec_scan
+        return cascade_scan(chunks, model, triage_model, threshold, deep_scan, health, prefix="Detailed Line Changes:\n", suffix=context, repo_context=repo_context)
 
     # Send the summary for scanning
     if health:
-        result = partial_health_scan(changes_summary, model)
+        result = partial_health_scan(changes_summary, model, repo_context)
     else:
-        result = partial_sec_scan(changes_summary, model)
+        result = partial_sec_scan(changes_summary, model, repo_context)
     return result
 
+def hunk_key(file, hunk, model, health=False):
+    """
+    Returns the cache key for the findings on a hunk. The hunk header is left out so a hunk that only moved keeps its findings.
+    """
+    task = prompts.partial_health_task if health else prompts.partial_security_task
+    digest = hashlib.sha1()
+    for part in (model, task, file, *hunk["lines"]):
+        digest.update(part.encode('utf-8', errors='replace') + b"\n")
+    return digest.hexdigest()
+
+def hunk_new_range(hunk):
+    """
+    Returns the (start, end) lines a hunk covers in the new version of its file. Whole-file hunks start at line 1.
+    """
+    return depgraph.hunk_range(hunk) or (1, max(len(hunk["lines"]), 1))
+
+def assign_findings(parsed, file_diffs):
+    """
+    Returns one list of findings per hunk in file_diffs, giving each finding to the hunk of its file that contains or
+    is nearest to its line. Lines in the hunk's own file are stored relative to the hunk's start, so the findings
+    still point at the right lines after the hunk moves. Findings for other files go to the first hunk.
+    """
+    hunks = [(file_diff["file"], *hunk_new_range(hunk)) for file_diff in file_diffs for hunk in file_diff["hunks"]]
+    assigned = [[] for _ in hunks]
+    for finding in parsed:
+        candidates = [i for i, (file, _, _) in enumerate(hunks) if file == finding["file"]]
+        if not candidates:
+            assigned[0].append(finding)
+            continue
+        line = finding["start_line"]
+        if line:
+            best = min(candidates, key=lambda i: 0 if hunks[i][1] <= line <= hunks[i][2] else min(abs(line - hunks[i][1]), abs(line - hunks[i][2])))
+        else:
+            best = candidates[0]
+        stored = dict(finding)
+        if line:
+            stored["start_line"] = line - hunks[best][1]
+            stored["end_line"] = finding["end_line"] - hunks[best][1]
+            stored["relative"] = True
+        assigned[best].append(stored)
+    return assigned
+
+def _cached_hunk_findings(file, hunk, model, health):
+    """
+    Returns the cached findings for a hunk with their lines in the hunk's current position, or None if it wasn't reviewed.
+    """
+    cached = cache.read_cached('hunk-findings', hunk_key(file, hunk, model, health))
+    if cached is None:
+        return None
+    try:
+        stored = json.loads(cached)
+    except ValueError:
+        return None
+    start, _ = hunk_new_range(hunk)
+    current = []
+    for finding in stored:
+        if finding.pop("relative", False):
+            finding["start_line"] += start
+            finding["end_line"] += start
+        current.append(finding)
+    return current
+
+def review_new_hunks(directory, file_diffs, model, health=False, related_tokens=retrieval.DEFAULT_RELATED_TOKENS, dependents_tokens=depgraph.DEFAULT_DEPENDENTS_TOKENS):
+    """
+    Sends only the hunks that have no cached findings for review, and caches the findings of each hunk separately.
+    Returns (findings, reused, reviewed): the findings for every hunk in file_diffs, including the ones reused from
+    earlier reviews, and the number of hunks that were reused and reviewed.
+    """
+    new_diffs = []
+    reused = 0
+    for file_diff in file_diffs:
+        hunks = [hunk for hunk in file_diff["hunks"] if _cached_hunk_findings(file_diff["file"], hunk, model, health) is None]
+        reused += len(file_diff["hunks"]) - len(hunks)
+        if hunks:
+            new_diffs.append(dict(file_diff, hunks=hunks))
+
+    reviewed = 0
+    if new_diffs:
+        changes_summary, _ = build_changes_summary(directory, new_diffs, [d["file"] for d in new_diffs], related_tokens, dependents_tokens)
+        print(f"Payload size: ~{tokens.estimate_tokens(changes_summary)} tokens")
+
+        task = prompts.partial_health_task if health else prompts.partial_security_task
+        # Findings are kept per hunk, so watch mode always asks for structured findings
+        result = run_review(task, changes_summary, model, prompts.repository_context(directory), structured=True)
+        # Failed requests aren't cached so the hunks are sent again on the next change
+        if result.startswith("Error occurred:"):
+            print(color_text(result, "31"))
+        else:
+            hunks = [(file_diff["file"], hunk) for file_diff in new_diffs for hunk in file_diff["hunks"]]
+            for (file, hunk), stored in zip(hunks, assign_findings(findings.parse_findings(result), new_diffs)):
+                cache.write_cached(json.dumps(stored), 'hunk-findings', hunk_key(file, hunk, model, health))
+            reviewed = len(hunks)
+
+    current = []
+    for file_diff in file_diffs:
+        for hunk in file_diff["hunks"]:
+            current.extend(_cached_hunk_findings(file_diff["file"], hunk, model, health) or [])
+    return current, reused, reviewed
+
+def watch_scan(directory, model, health=False, debounce=watcher.DEFAULT_DEBOUNCE, related_tokens=retrieval.DEFAULT_RELATED_TOKENS, dependents_tokens=depgraph.DEFAULT_DEPENDENTS_TOKENS):
+    """
+    Reviews the local changes, then watches the directory and reviews again each time files are saved.
+    Only files with filesystem events are diffed again, and only hunks without cached findings are sent to the model.
+    Each update prints the findings for every current hunk, cached ones included.
+    """
+    # The latest diff of every changed file, so a save only re-diffs the files it touched
+    diffs = {}
+
+    def review(touched):
+        changed_files = get_changed_files(directory) or []
+        to_diff = [f for f in changed_files if touched is None or '' in touched or os.path.normpath(f) in touched or f not in diffs]
+        for file in list(diffs):
+            if file not in changed_files or file in to_diff:
+                del diffs[file]
+        if to_diff:
+            for file_diff in get_file_diffs(directory, to_diff):
+                diffs[file_diff["file"]] = file_diff
+
+        current, reused, reviewed = review_new_hunks(directory, [diffs[f] for f in sorted(diffs)], model, health, related_tokens, dependents_tokens)
+        stamp = time.strftime('%H:%M:%S')
+        if reviewed:
+            print(color_text(f"[{stamp}] Reviewed {reviewed} new or modified hunks, reused findings for {reused} unchanged hunks", "32"))
+        else:
+            print(color_text(f"[{stamp}] No new or modified hunks reviewed, {reused} already reviewed", "34"))
+        # Every update shows the findings for all current changes, not just the ones from this review
+        print(f"{len(current)} findings for the current changes:")
+        for finding in current:
+            print(findings.format_finding(finding))
+
+    review(None)
+    for touched in watcher.watch_changes(directory, ignore=should_ignore, debounce=debounce):
+        print(color_text(f"\nChanged: {', '.join(sorted(p for p in touched if p)) or 'unknown, events were lost'}", "34"))
+        review(touched)
+
 def main():
     """
     Main function to perform full or partial security scanning.
@@ -653,29 +1123,87 @@ def main():
 
     # Set the default model based on the mode
     default_model = 'gpt-4o' if mode == 'full' else 'gpt-4o'
-    print("Running in mode:", mode, "with model:", default_model)
 
     # Set up argparse for the --model argument with the conditional default
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--model', type=str, default=default_model, help='Name of the model to use, must match exactly from https://platform.openai.com/docs/models/ or for Google Gemini use gemini-pro')
     parser.add_argument('--health', action='store_true', help='Focus on health and optimization instead of security')
+    parser.add_argument('--cascade', action='store_true', help='Triage each file with a small model first and only send risky files to --model')
+    parser.add_argument('--triage-model', type=str, default='gpt-4o-mini', help='Small, fast model used to triage files when --cascade is set')
+    parser.add_argument('--threshold', type=float, default=5, help='Risk score from 0 to 10 at which --cascade escalates a file to --model')
+    parser.add_argument('--deadline', type=str, default=None, help='For full scans, stop starting new requests when this wall-clock time would be exceeded, e.g. 120s or 5m')
+    parser.add_argument('--max-tokens', type=int, default=None, help='For full scans, stop starting new requests when this many input tokens would be exceeded')
+    parser.add_argument('--related-tokens', type=int, default=retrieval.DEFAULT_RELATED_TOKENS, help='For partial scans, how many tokens of related code to add from the local retrieval index, 0 turns it off')
+    parser.add_argument('--dependents-tokens', type=int, default=depgraph.DEFAULT_DEPENDENTS_TOKENS, help='For partial scans, how many tokens of call sites and imports that depend on the changed code to add from the dependency graph, 0 turns it off')
+    parser.add_argument('--debounce', type=float, default=watcher.DEFAULT_DEBOUNCE, help='For watch mode, how many seconds to wait after the last file change before reviewing, greater than 0')
+    parser.add_argument('--compact', action='store_true', help='Strip license headers, comment banners, extra whitespace and base64 blobs from file contents before sending them')
+    parser.add_argument('--full-files', action='store_true', help='For github scans, send the full content of every changed file instead of the diff hunks')
+    parser.add_argument('--shard', type=str, default=None, help='Scan only shard <index>/<count> of the files, e.g. 1/4, and write a shard report for latio merge')
+    parser.add_argument('--shard-strategy', type=str, default='hash', choices=sharding.shard_strategies, help='Partition files by path hash or balance shards by file size')
+    parser.add_argument('--report', type=str, default=None, help='Where to write the shard report, defaults to latio-<mode>-shard-<index>-of-<count>.json')
+    parser.add_argument('--format', type=str, default='text', choices=findings.output_formats, help='Print the result as text, or stream each finding as it arrives as NDJSON or SARIF')
+    parser.add_argument('--output', type=str, default=None, help='Where latio merge writes the merged report, or where --format ndjson|sarif writes findings')
     args, remaining_argv = parser.parse_known_args(sys.argv[2:])
+    triage_model = args.triage_model if args.cascade else None
+
+    deadline = None
+    if args.deadline:
+        try:
+            deadline = planner.parse_deadline(args.deadline)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+    shard = None
+    if args.shard:
+        try:
+            shard = sharding.parse_shard(args.shard)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+    if args.format != 'text' and mode != 'merge':
+        if args.output:
+            findings.start(args.format, open(args.output, 'w'), close=True)
+        else:
+            # stdout carries only findings, progress and the text result go to stderr
+            findings.start(args.format, sys.stdout)
+            sys.stdout = sys.stderr
+        # Early exits and uncaught errors still close the SARIF document and the output file
+        atexit.register(findings.finish)
+
+    print("Running in mode:", mode, "with model:", default_model)
 
     # Remaining arguments and main logic
     if mode == 'full':
         if len(remaining_argv) < 1:
-            print("Usage for full scan: latio full <directory>")
+            print("Usage for full scan: latio full <directory> [--shard <index>/<count>]")
             sys.exit(1)
         directory = remaining_argv[0]
-        print(full_scan(directory, model=args.model, health=args.health))
+        if shard:
+            files = sharding.select_shard(directory, list_shard_files(directory), shard, args.shard_strategy)
+        else:
+            files = list_scan_files(directory)
+        result = full_scan(directory, model=args.model, health=args.health, files=files, compact=args.compact, triage_model=triage_model, threshold=args.threshold, deadline=deadline, max_tokens=args.max_tokens)
+        if shard:
+            report_path = args.report or sharding.default_report_path(mode, shard)
+            sharding.write_shard_report(report_path, mode, directory, shard, args.shard_strategy, files, result, args.model, args.health, findings.collected())
+        print(result)
 
     elif mode == 'full-agentic':
         if len(remaining_argv) < 1:
-            print("Usage for full scan: latio full-agentic <directory>")
+            print("Usage for full scan: latio full-agentic <directory> [--shard <index>/<count>]")
             sys.exit(1)
         directory = remaining_argv[0]
         try:
-            result = asyncio.run(full_agent_scan(directory, model=args.model, health=args.health))
+            if shard:
+                files = sharding.select_shard(directory, list_shard_files(directory), shard, args.shard_strategy)
+            else:
+                files = list_scan_files(directory, ignore=True)
+            result = asyncio.run(full_agent_scan(directory, model=args.model, health=args.health, files=files, deadline=deadline, max_tokens=args.max_tokens))
+            if shard:
+                report_path = args.report or sharding.default_report_path(mode, shard)
+                sharding.write_shard_report(report_path, mode, directory, shard, args.shard_strategy, files, str(result), args.model, args.health, findings.collected())
             print(result)
         except Exception as e:
             print(f"Error during partial scan: {e}")
@@ -689,7 +1217,7 @@ def main():
         repo_name = remaining_argv[0]
         pr_number = int(remaining_argv[1])
         github_token = os.environ.get('GITHUB_TOKEN')
-        print(github_scan(repo_name, pr_number, github_token, model=args.model, health=args.health))
+        print(github_scan(repo_name, pr_number, github_token, model=args.model, health=args.health, full_files=args.full_files))
 
     elif mode == 'partial-agentic':
         if len(remaining_argv) < 1:
@@ -698,7 +1226,7 @@ def main():
         directory = remaining_argv[0]
         # Use asyncio.run to execute the async function
         try:
-            result = asyncio.run(partial_agent_scan(directory, model=args.model, health=args.health))
+            result = asyncio.run(partial_agent_scan(directory, model=args.model, health=args.health, related_tokens=args.related_tokens, dependents_tokens=args.dependents_tokens))
             print(result)
         except Exception as e:
             print(f"Error during partial scan: {e}")
@@ -710,7 +1238,21 @@ def main():
             print("Usage for full scan: latio partial <directory>")
             sys.exit(1)
         directory = remaining_argv[0]
-        print(partial_scan(directory, model=args.model, health=args.health))
+        print(partial_scan(directory, model=args.model, health=args.health, triage_model=triage_model, threshold=args.threshold, related_tokens=args.related_tokens, dependents_tokens=args.dependents_tokens))
+
+    elif mode == 'watch':
+        if len(remaining_argv) < 1:
+            print("Usage for watch: latio watch <directory>")
+            sys.exit(1)
+        directory = remaining_argv[0]
+        # A zero timeout would busy-spin the watcher and a negative one makes select raise
+        if args.debounce <= 0:
+            print(f"Invalid debounce '{args.debounce:g}', expected a number of seconds greater than 0")
+            sys.exit(1)
+        try:
+            watch_scan(directory, model=args.model, health=args.health, debounce=args.debounce, related_tokens=args.related_tokens, dependents_tokens=args.dependents_tokens)
+        except KeyboardInterrupt:
+            print("\nStopped watching")
 
     elif mode == 'partial-github':
         if len(remaining_argv) < 3:
@@ -719,12 +1261,29 @@ def main():
         directory = remaining_argv[0]
         base_ref = remaining_argv[1]
         head_ref = remaining_argv[2]
-        print(partial_scan_github(directory, base_ref, head_ref, model=args.model, health=args.health))
+        print(partial_scan_github(directory, base_ref, head_ref, model=args.model, health=args.health, compact=args.compact))
+
+    elif mode == 'merge':
+        if len(remaining_argv) < 1:
+            print("Usage for merge: latio merge <shard_report> [<shard_report> ...] [--output <merged_report>]")
+            sys.exit(1)
+        try:
+            merged = sharding.merge_shard_reports(remaining_argv)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error merging shard reports: {e}")
+            sys.exit(1)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(merged, f, indent=2)
+            print(f"Wrote merged report to {args.output}")
+        print(sharding.format_merged_report(merged))
 
     else:
         print("Invalid mode. Use 'full' or 'partial'.")
         sys.exit(1)
 
+    findings.finish()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
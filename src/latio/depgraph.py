@@ -0,0 +1,351 @@
+import ast
+import os
+import posixpath
+import re
+try:
+    from . import gitindex
+    from . import tokens
+except ImportError:
+    import gitindex
+    import tokens
+
+INDEX_VERSION = 2
+DEFAULT_DEPENDENTS_TOKENS = 3000
+CONTEXT_LINES = 3
+
+# Languages imported by dotted module name rather than by path
+dotted_extensions = {'.py', '.java', '.kt', '.scala'}
+
+# Import statements for languages without a parser here, each capturing the imported module or path
+js_imports = [
+    re.compile(r'''^\s*import\s+(?:[\w*{}\s,]+\s+from\s+)?['"]([^'"]+)['"]'''),
+    re.compile(r'''^\s*export\s+[\w*{}\s,]+\s+from\s+['"]([^'"]+)['"]'''),
+    re.compile(r'''require\s*\(\s*['"]([^'"]+)['"]'''),
+]
+import_patterns = {
+    '.js': js_imports, '.jsx': js_imports, '.mjs': js_imports, '.cjs': js_imports, '.ts': js_imports, '.tsx': js_imports, '.vue': js_imports,
+    '.rb': [re.compile(r'''^\s*require(?:_relative)?\s*\(?\s*['"]([^'"]+)['"]''')],
+    '.java': [re.compile(r'''^\s*import\s+(?:static\s+)?([\w.]+?)(?:\.\*)?\s*;''')],
+    '.kt': [re.compile(r'''^\s*import\s+([\w.]+?)(?:\.\*)?\s*$''')],
+    '.scala': [re.compile(r'''^\s*import\s+([\w.]+?)(?:\.[_{].*)?\s*$''')],
+    '.c': [re.compile(r'''^\s*#\s*include\s+"([^"]+)"''')],
+    '.h': [re.compile(r'''^\s*#\s*include\s+"([^"]+)"''')],
+    '.cc': [re.compile(r'''^\s*#\s*include\s+"([^"]+)"''')],
+    '.cpp': [re.compile(r'''^\s*#\s*include\s+"([^"]+)"''')],
+    '.hpp': [re.compile(r'''^\s*#\s*include\s+"([^"]+)"''')],
+    # Single imports and the lines inside an import ( ... ) block
+    '.go': [re.compile(r'''^\s*(?:import\s+)?(?:[\w.]+\s+)?"([\w./-]+)"\s*$''')],
+    '.php': [re.compile(r'''^\s*(?:require|include)(?:_once)?\s*\(?\s*['"]([^'"]+)['"]''')],
+    '.rs': [re.compile(r'''^\s*(?:pub\s+)?(?:use|mod)\s+([\w:]+)''')],
+}
+
+definition_pattern = re.compile(r'^\s*(?:export\s+)?(?:pub\s+)?(?:async\s+)?(?:def|function|func|fn|sub)\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)')
+call_pattern = re.compile(r'\b([A-Za-z_]\w*)\s*\(')
+not_calls = {'if', 'for', 'while', 'switch', 'return', 'catch', 'function', 'def', 'func', 'fn', 'elif', 'print', 'and', 'or', 'not', 'in', 'sizeof'}
+
+# Graphs already built in this process, keyed by commit
+_loaded_graphs = {}
+
+
+def module_keys(path):
+    """
+    Returns every name a file can be imported by: each dotted or slash-separated suffix of its path without extension.
+    Package files (__init__.py, index.js) can also be imported by their directory.
+    """
+    stem, extension = posixpath.splitext(path)
+    parts = stem.split('/')
+    if parts[-1] in ('__init__', 'index', 'mod'):
+        parts = parts[:-1] or parts
+    separator = '.' if extension in dotted_extensions else '/'
+    keys = {separator.join(parts[i:]) for i in range(len(parts))}
+    if extension == '.go':
+        directories = stem.split('/')[:-1]
+        keys.update('/'.join(directories[i:]) for i in range(len(directories)))
+    return sorted(keys)
+
+
+def _dotted_name(node):
+    """
+    Returns the dotted name of a Name or Attribute chain like a.b.c, or None for any other expression.
+    """
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+def _python_facts(path, text):
+    """
+    Returns imports, definitions and calls for Python source using ast, or None if it doesn't parse.
+    Also returns the names each import binds, so calls can be resolved to the module they come from:
+    calls are [name, line, enclosing function, receiver], where receiver is the dotted expression before the
+    name (None for a bare call), and definitions are [name, start, end, kind] with kind function, method or class.
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    package = posixpath.dirname(path).split('/') if posixpath.dirname(path) else []
+    imports = []
+    definitions = []
+    calls = []
+    # Local name -> the qualified names it may be bound to, a name can be imported in a try and an except branch
+    bindings = {}
+    star_modules = []
+
+    def bind(name, qualified):
+        if qualified not in bindings.setdefault(name, []):
+            bindings[name].append(qualified)
+
+    def visit(node, enclosing, in_class):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.Import):
+                for alias in child.names:
+                    imports.append([alias.name, child.lineno])
+                    # import a.b binds a, import a.b as c binds c to a.b
+                    if alias.asname:
+                        bind(alias.asname, alias.name)
+                    else:
+                        top = alias.name.split('.')[0]
+                        bind(top, top)
+            elif isinstance(child, ast.ImportFrom):
+                if child.level:
+                    # Relative imports resolve against the file's own package in the repository
+                    base = package[:len(package) - child.level + 1] if child.level <= len(package) + 1 else []
+                    module = '.'.join(base + ([child.module] if child.module else []))
+                else:
+                    module = child.module or ''
+                imports.append([module, child.lineno])
+                for alias in child.names:
+                    if alias.name == '*':
+                        star_modules.append(module)
+                        continue
+                    imports.append([f"{module}.{alias.name}".strip('.'), child.lineno])
+                    bind(alias.asname or alias.name, f"{module}.{alias.name}".strip('.'))
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if isinstance(child, ast.ClassDef):
+                    kind = "class"
+                else:
+                    kind = "method" if in_class else "function"
+                definitions.append([child.name, child.lineno, getattr(child, 'end_lineno', child.lineno), kind])
+                visit(child, child.name, isinstance(child, ast.ClassDef))
+                continue
+            elif isinstance(child, ast.Call):
+                function = child.func
+                if isinstance(function, ast.Name):
+                    calls.append([function.id, child.lineno, enclosing, None])
+                elif isinstance(function, ast.Attribute):
+                    # Receivers that aren't plain names, like f().get(), are kept as "?" and can't be resolved
+                    calls.append([function.attr, child.lineno, enclosing, _dotted_name(function.value) or "?"])
+            visit(child, enclosing, False)
+
+    visit(tree, None, False)
+    return {"imports": imports, "definitions": definitions, "calls": calls, "bindings": bindings, "star_modules": star_modules}
+
+
+def _python_call_targets(call, facts):
+    """
+    Returns the (module, name) pairs a Python call can refer to, using the names the file's imports bind.
+    The module is None when the receiver is a local object, whose type isn't known without running the code.
+    Calls to names the file defines itself or gets from builtins return nothing.
+    """
+    name, receiver = call[0], call[3]
+    bindings = facts.get("bindings", {})
+    if receiver is None:
+        targets = [tuple(q.rsplit('.', 1)) for q in bindings.get(name, []) if '.' in q]
+        return targets + [(module, name) for module in facts.get("star_modules", [])]
+    root = receiver.split('.', 1)[0]
+    if root in bindings:
+        return [(qualified + receiver[len(root):], name) for qualified in bindings[root]]
+    return [(None, name)]
+
+
+def _heuristic_facts(path, text):
+    """
+    Returns imports, definitions and calls for other languages from import statements and name( patterns,
+    or None for files that aren't code in a known language.
+    """
+    patterns = import_patterns.get(posixpath.splitext(path)[1])
+    if patterns is None:
+        return None
+    directory = posixpath.dirname(path)
+    imports = []
+    definitions = []
+    calls = []
+    lines = text.splitlines()
+    for number, line in enumerate(lines, 1):
+        for pattern in patterns:
+            match = pattern.search(line)
+            if match:
+                target = match.group(1).replace('::', '/')
+                if target.startswith('.'):
+                    # Relative paths resolve against the importing file, like JS and Ruby do
+                    target = posixpath.normpath(posixpath.join(directory, target))
+                imports.append([posixpath.splitext(target)[0] if '/' in target else target, number])
+                break
+        definition = definition_pattern.match(line)
+        if definition:
+            if definitions:
+                definitions[-1][2] = number - 1
+            definitions.append([definition.group(1), number, len(lines)])
+        enclosing = definitions[-1][0] if definitions else None
+        for name in call_pattern.findall(line):
+            if name not in not_calls and not (definition and name == definition.group(1)):
+                calls.append([name, number, enclosing])
+    return {"imports": imports, "definitions": definitions, "calls": calls}
+
+
+def extract_facts(path, text):
+    """
+    Returns the imports, definitions and call sites of a source file for the dependency graph, or None if it isn't code.
+    """
+    if path.endswith('.py'):
+        facts = _python_facts(path, text)
+        if facts is not None:
+            return facts
+    return _heuristic_facts(path, text)
+
+
+def build_graph(directory):
+    """
+    Returns the dependency graph of the HEAD commit: per-file facts and a map from module key to importing files.
+    Facts are stored per commit by gitindex, so only blobs changed since the last graph are parsed again.
+    """
+    head = gitindex.head_commit(directory)
+    if not head:
+        return None
+    if head not in _loaded_graphs:
+        files = gitindex.load_index(directory, 'depgraph', INDEX_VERSION, extract_facts) or {}
+        importers = {}
+        for path in sorted(files):
+            facts = files[path]["data"]
+            for module, line in (facts or {}).get("imports", []):
+                importers.setdefault(module, []).append((path, line))
+        _loaded_graphs[head] = {"files": files, "importers": importers}
+    return _loaded_graphs[head]
+
+
+def hunk_range(hunk):
+    """
+    Returns the (start, end) lines a hunk covers in the new version of the file, or None if it has no hunk header.
+    """
+    match = re.match(r'@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', hunk["header"] or '')
+    if not match:
+        return None
+    start = int(match.group(1))
+    return start, start + max(int(match.group(2) or 1), 1) - 1
+
+
+def changed_ranges(file_diff):
+    """
+    Returns the (start, end) line ranges a diff touches in the new version of the file.
+    """
+    return [r for r in map(hunk_range, file_diff["hunks"]) if r]
+
+
+def changed_definitions(directory, file_diff):
+    """
+    Returns {name: kind} for the functions, methods and classes a diff changes, adds or removes.
+    """
+    path = file_diff["file"]
+    names = {}
+    try:
+        with open(os.path.join(directory, path), 'r', encoding='utf-8', errors='replace') as f:
+            facts = extract_facts(path, f.read()) or {"definitions": []}
+    except OSError:
+        facts = {"definitions": []}
+    ranges = changed_ranges(file_diff)
+    for definition in facts["definitions"]:
+        name, start, end = definition[:3]
+        if file_diff["status"] != "modified" or any(start <= high and low <= end for low, high in ranges):
+            names[name] = definition[3] if len(definition) > 3 else "function"
+    # Definitions removed by the diff no longer exist in the file but their callers still do
+    for hunk in file_diff["hunks"]:
+        for line in hunk["lines"]:
+            if line.startswith('-'):
+                definition = definition_pattern.match(line[1:]) or re.match(r'\s*class\s+([A-Za-z_]\w*)', line[1:])
+                if definition and definition.group(1) not in names:
+                    # An indented def was most likely a method
+                    names[definition.group(1)] = "method" if line[1:2].isspace() and 'class' not in line else "function"
+    return names
+
+
+def dependents(directory, file_diffs):
+    """
+    Returns the sites that can be affected by a diff as (path, line, description) tuples: calls to changed
+    functions from files that import the changed file, or the import itself when no changed function is called.
+    Python calls are resolved through the importing file's imports, so requests.get() doesn't match a changed get()
+    in another module; calls on local objects only match changed methods. Other languages match calls by name.
+    """
+    graph = build_graph(directory)
+    if not graph:
+        return []
+    changed_paths = {file_diff["file"] for file_diff in file_diffs}
+    sites = []
+    seen = set()
+    for file_diff in file_diffs:
+        names = changed_definitions(directory, file_diff)
+        keys = module_keys(file_diff["file"])
+        importing = {}
+        for key in keys:
+            for path, line in graph["importers"].get(key, []):
+                if path not in changed_paths:
+                    importing.setdefault(path, line)
+        for path, import_line in sorted(importing.items()):
+            facts = graph["files"][path]["data"] or {}
+            called = []
+            for call in facts.get("calls", []):
+                name, line, caller = call[:3]
+                if "bindings" not in facts:
+                    if name in names:
+                        called.append((name, line, caller))
+                    continue
+                for module, target in _python_call_targets(call, facts):
+                    if module is None:
+                        resolved = names.get(target) == "method"
+                    else:
+                        # A module function, or a method called through its class, like mod.Class.method()
+                        resolved = target in names and (module in keys or module.rsplit('.', 1)[0] in keys)
+                    if resolved:
+                        called.append((target, line, caller))
+                        break
+            for name, line, caller in called:
+                if (path, line) not in seen:
+                    seen.add((path, line))
+                    sites.append((path, line, f"calls {name}" + (f" from {caller}" if caller else "")))
+            if not called and (path, import_line) not in seen:
+                seen.add((path, import_line))
+                sites.append((path, import_line, f"imports {file_diff['file']}"))
+    return sites
+
+
+def impacted_code(directory, file_diffs, max_tokens=DEFAULT_DEPENDENTS_TOKENS):
+    """
+    Returns the call sites and imports affected by a diff with a few lines of context, capped at max_tokens.
+    """
+    if max_tokens <= 0 or not file_diffs:
+        return ""
+    sites = dependents(directory, file_diffs)
+    if not sites:
+        return ""
+    graph = build_graph(directory)
+    blobs = gitindex.read_blobs(directory, list({graph["files"][path]["sha"] for path, _, _ in sites}))
+
+    output = ""
+    used_tokens = 0
+    for path, line, description in sites:
+        lines = blobs.get(graph["files"][path]["sha"], b"").decode('utf-8', errors='replace').splitlines()
+        start = max(line - CONTEXT_LINES, 1)
+        end = min(line + CONTEXT_LINES, len(lines))
+        snippet = f"\nFile: {path} (line {line}, {description})\n" + "\n".join(lines[start - 1:end]) + "\n"
+        snippet_tokens = tokens.estimate_tokens(snippet)
+        if used_tokens + snippet_tokens > max_tokens:
+            continue
+        output += snippet
+        used_tokens += snippet_tokens
+    print(f"Found {len(sites)} impacted sites, added {used_tokens} tokens of impacted code")
+    return output
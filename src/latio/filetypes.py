@@ -0,0 +1,224 @@
+import atexit
+import json
+import os
+import re
+try:
+    from . import cache
+except ImportError:
+    import cache
+
+# Number of bytes sniffed from the start of every file before deciding whether it is worth reading
+SNIFF_BYTES = 8192
+
+# Files whose first bytes match one of these are binaries no matter what their extension says, as long as the
+# sniffed head also has a byte that never appears in text. Short magics like MZ or RIFF also start ordinary source.
+magic_numbers = [
+    b'\x7fELF',              # ELF executables and shared objects
+    b'MZ',                   # Windows executables and DLLs
+    b'\xca\xfe\xba\xbe',     # Java class files and Mach-O fat binaries
+    b'\xcf\xfa\xed\xfe',     # Mach-O 64-bit
+    b'\xce\xfa\xed\xfe',     # Mach-O 32-bit
+    b'PK\x03\x04',           # zip, jar, war, docx, xlsx, wheels
+    b'\x1f\x8b',             # gzip
+    b'BZh',                  # bzip2
+    b'\xfd7zXZ\x00',         # xz
+    b'7z\xbc\xaf\x27\x1c',   # 7z
+    b'Rar!\x1a\x07',         # rar
+    b'%PDF',                 # pdf
+    b'\x89PNG',              # png
+    b'\xff\xd8\xff',         # jpeg
+    b'GIF87a',
+    b'GIF89a',
+    b'RIFF',                 # wav, webp, avi
+    b'OggS',
+    b'ID3',                  # mp3
+    b'\x00asm',              # WebAssembly
+    b'wOFF',
+    b'wOF2',
+    b'SQLite format 3\x00',
+]
+
+# Generated files that are recognisable by name alone
+generated_filenames = {
+    'package-lock.json',
+    'yarn.lock',
+    'pnpm-lock.yaml',
+    'poetry.lock',
+    'Pipfile.lock',
+    'Cargo.lock',
+    'Gemfile.lock',
+    'composer.lock',
+    'go.sum',
+    'mix.lock',
+    'pubspec.lock',
+    'packages.lock.json',
+}
+
+generated_suffixes = [
+    '.lock',
+    '.min.js',
+    '.min.css',
+    '.bundle.js',
+    '.bundle.css',
+    '.map',
+    '_pb2.py',
+    '_pb2.pyi',
+    '_pb2_grpc.py',
+    '.pb.go',
+    '_grpc.pb.go',
+    '.pb.cc',
+    '.pb.h',
+    '_pb.js',
+    '_pb.d.ts',
+    '_grpc_pb.js',
+    '.g.dart',
+    '.freezed.dart',
+    '.designer.cs',
+    '.generated.cs',
+]
+
+# Markers code generators leave in the first few lines of their output
+generated_header = re.compile(
+    rb'(DO NOT EDIT|@generated|Generated by the protocol buffer compiler|'
+    rb'(this|the) (file|code) (is|was) (auto-?)?generated)',
+    re.IGNORECASE,
+)
+
+# Bytes that show up in ordinary text files: tab, newline, form feed, carriage return, escape and printable ASCII
+text_bytes = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x7f)) | set(range(0x80, 0x100)))
+
+# Results from earlier runs keyed by absolute path, each stored with the size and mtime it was classified at.
+# Loaded from the latio cache on first use and written back when the process exits if anything was added.
+_classification_cache = None
+_classification_dirty = False
+
+
+def _looks_minified(head):
+    """
+    Returns True when the sniffed head is a single very long line, which is how bundlers emit code.
+    """
+    first_line = head.split(b'\n', 1)[0]
+    return len(first_line) >= 1000 and head.count(b'\n') <= 2
+
+
+def classify_name(name):
+    """
+    Returns "generated" if the file name alone marks it as a lockfile, bundle or generated stub, otherwise None.
+    """
+    name = os.path.basename(name)
+    if name in generated_filenames:
+        return "generated"
+    for suffix in generated_suffixes:
+        if name.endswith(suffix):
+            return "generated"
+    return None
+
+
+def _classify_head(name, head):
+    """
+    Returns the reason a file should be skipped based on its name and first bytes, or None if it is source worth scanning.
+    """
+    non_text = head.translate(None, text_bytes)
+    if non_text and any(head.startswith(magic) for magic in magic_numbers):
+        return "binary"
+    if b'\x00' in head:
+        return "binary"
+    if head and len(non_text) / len(head) > 0.30:
+        return "binary"
+
+    if classify_name(name):
+        return "generated"
+    first_lines = b'\n'.join(head.splitlines()[:5])
+    if generated_header.search(first_lines):
+        return "generated"
+    if _looks_minified(head):
+        return "generated"
+    return None
+
+
+def classify_content(name, data):
+    """
+    Returns "binary", "generated" or None for content that is already in memory, such as a git blob.
+    """
+    return _classify_head(os.path.basename(name), data[:SNIFF_BYTES])
+
+
+def _load_classifications():
+    """
+    Returns the persistent classification cache, reading it from disk the first time.
+    """
+    global _classification_cache
+    if _classification_cache is None:
+        try:
+            _classification_cache = json.loads(cache.read_cached('filetypes.json') or '{}')
+        except ValueError:
+            _classification_cache = {}
+        atexit.register(_save_classifications)
+    return _classification_cache
+
+
+def _save_classifications():
+    """
+    Writes the classification cache back to disk if this run classified any new or changed files.
+    """
+    if _classification_dirty:
+        cache.write_cached(json.dumps(_classification_cache), 'filetypes.json')
+
+
+def classify_file(file_path):
+    """
+    Returns "binary", "generated" or None for a file by sniffing only its first few KB.
+    Results are kept on disk by path, size and mtime, so repeated scans skip unchanged files without opening them.
+    """
+    global _classification_dirty
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return "unreadable"
+    classifications = _load_classifications()
+    key = os.path.abspath(file_path)
+    cached = classifications.get(key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return "unreadable"
+    reason = _classify_head(os.path.basename(file_path), head)
+    classifications[key] = [stat.st_size, stat.st_mtime_ns, reason]
+    _classification_dirty = True
+    return reason
+
+
+def should_skip_file(file_path):
+    """
+    Returns True if the file is binary, generated or unreadable and should not be sent to the model.
+    """
+    reason = classify_file(file_path)
+    if reason:
+        print(f"Skipping {file_path} ({reason})")
+        return True
+    return False
+
+
+def read_text_file(file_path):
+    """
+    Returns the decoded contents of a text file, or None if the file should be skipped.
+    Binaries and generated files are rejected before the full read, so they are never decoded at all.
+    """
+    if should_skip_file(file_path):
+        return None
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
@@ -0,0 +1,171 @@
+import json
+import re
+import threading
+
+output_formats = ['text', 'ndjson', 'sarif']
+severities = ['critical', 'high', 'medium', 'low', 'info']
+sarif_levels = {'critical': 'error', 'high': 'error', 'medium': 'warning', 'low': 'note', 'info': 'note'}
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+TOOL_URI = "https://github.com/latiotech/LAST"
+
+# Where findings are streamed for this run, None when results are printed as text
+_output = None
+_lock = threading.Lock()
+
+
+def start(output_format, stream, close=False):
+    """
+    Starts streaming findings to stream. For SARIF the document is opened here and each result is appended as it arrives.
+    With close, finish closes the stream, for output files opened by the caller.
+    """
+    global _output
+    if output_format == 'text':
+        return
+    _output = {"format": output_format, "stream": stream, "count": 0, "close": close, "findings": []}
+    if output_format == 'sarif':
+        stream.write('{"version": "2.1.0", "$schema": ' + json.dumps(SARIF_SCHEMA) + ', "runs": [{"tool": {"driver": '
+                     + json.dumps({"name": "latio", "informationUri": TOOL_URI}) + '}, "results": [\n')
+        stream.flush()
+
+
+def active():
+    """
+    Returns True if findings are being streamed, so scans should ask the model for structured findings.
+    """
+    return _output is not None
+
+
+def _extract_json(text):
+    """
+    Returns the JSON value in a model response, which may be wrapped in a markdown code fence or surrounded by prose.
+    """
+    fenced = re.search(r'```(?:json)?\s*(.*?)```', text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        raise ValueError("no JSON in response")
+    value, _ = json.JSONDecoder().raw_decode(text[min(starts):])
+    return value
+
+
+def _line(value):
+    """
+    Returns a positive line number, or None if the model didn't give one.
+    """
+    try:
+        line = int(value)
+    except (TypeError, ValueError):
+        return None
+    return line if line > 0 else None
+
+
+def parse_findings(text):
+    """
+    Returns the findings in a model response as dicts with file, start_line, end_line, severity, rule and message.
+    A response that isn't the requested JSON, a {"findings": [...]} object or a list of finding objects, becomes a
+    single unstructured finding, so nothing the model said is lost.
+    """
+    try:
+        value = _extract_json(text)
+        items = value.get("findings") if isinstance(value, dict) else value
+        # Other JSON, like {"issues": [...]} or a "[1]" citation in prose, isn't findings
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("not a list of findings")
+    except ValueError:
+        return [{"file": None, "start_line": None, "end_line": None, "severity": "info", "rule": "unstructured", "message": text.strip()}]
+
+    findings = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("message"):
+            continue
+        start_line = _line(item.get("start_line"))
+        end_line = _line(item.get("end_line")) or start_line
+        severity = str(item.get("severity", "")).lower()
+        findings.append({
+            "file": str(item["file"]) if item.get("file") else None,
+            "start_line": start_line,
+            "end_line": max(end_line, start_line) if start_line else None,
+            "severity": severity if severity in severities else "medium",
+            "rule": str(item.get("rule") or "general"),
+            "message": str(item["message"]),
+        })
+    return findings
+
+
+def _sarif_result(finding):
+    """
+    Returns a finding as a SARIF result.
+    """
+    result = {
+        "ruleId": finding["rule"],
+        "level": sarif_levels[finding["severity"]],
+        "message": {"text": finding["message"]},
+        "properties": {"severity": finding["severity"]},
+    }
+    if finding["file"]:
+        location = {"artifactLocation": {"uri": finding["file"]}}
+        if finding["start_line"]:
+            location["region"] = {"startLine": finding["start_line"], "endLine": finding["end_line"]}
+        result["locations"] = [{"physicalLocation": location}]
+    return result
+
+
+def emit(text, model=None):
+    """
+    Parses a finished model response and writes its findings to the stream right away. Does nothing for text output.
+    """
+    if _output is None or not text:
+        return
+    if text.startswith("Error occurred:"):
+        print(f"Warning: no findings from a failed request: {text}")
+        return
+    findings = parse_findings(text)
+    with _lock:
+        stream = _output["stream"]
+        for finding in findings:
+            if _output["format"] == 'ndjson':
+                stream.write(json.dumps(dict(finding, model=model)) + "\n")
+            else:
+                stream.write((",\n" if _output["count"] else "") + json.dumps(_sarif_result(finding)))
+            _output["count"] += 1
+        _output["findings"].extend(findings)
+        stream.flush()
+    print(f"Emitted {len(findings)} findings")
+
+
+def collected():
+    """
+    Returns every finding streamed so far in this run, or None if findings aren't being streamed.
+    """
+    if _output is None:
+        return None
+    with _lock:
+        return list(_output["findings"])
+
+
+def format_finding(finding):
+    """
+    Returns a finding as one line of text for the terminal.
+    """
+    location = finding["file"] or "general"
+    if finding["file"] and finding["start_line"]:
+        location += f":{finding['start_line']}" + (f"-{finding['end_line']}" if finding["end_line"] != finding["start_line"] else "")
+    return f"[{finding['severity']}] {location} {finding['rule']}: {finding['message']}"
+
+
+def finish():
+    """
+    Closes the SARIF document once the scan is done. Safe to call more than once.
+    """
+    global _output
+    if _output is None:
+        return
+    if _output["format"] == 'sarif':
+        _output["stream"].write("\n]}]}\n")
+    _output["stream"].flush()
+    if _output["close"]:
+        _output["stream"].close()
+    print(f"Streamed {_output['count']} findings as {_output['format']}")
+    _output = None
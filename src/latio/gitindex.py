@@ -0,0 +1,177 @@
+import glob
+import hashlib
+import json
+import os
+import subprocess
+try:
+    from . import cache
+    from . import filetypes
+except ImportError:
+    import cache
+    import filetypes
+
+MAX_BLOB_BYTES = 1024 * 1024
+# Blobs are read in batches of about this many bytes, so a cold index never holds the whole tree in memory
+READ_BATCH_BYTES = 32 * 1024 * 1024
+# Indexes kept on disk per repository and index name, older commits are pruned
+MAX_INDEXES = 3
+
+# Indexes already loaded in this process, keyed by (name, commit)
+_loaded = {}
+
+
+def git(directory, *args, input=None):
+    """
+    Returns the raw output of a git command run in the directory, or None if it fails.
+    """
+    try:
+        return subprocess.run(["git", *args], cwd=directory, input=input, capture_output=True, check=True).stdout
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def head_commit(directory):
+    """
+    Returns the HEAD commit SHA, or None outside a git repository.
+    """
+    head = (git(directory, "rev-parse", "HEAD") or b"").strip().decode()
+    return head or None
+
+
+def read_blobs(directory, shas):
+    """
+    Returns a sha -> bytes mapping for git blobs, read in one git cat-file call.
+    """
+    if not shas:
+        return {}
+    output = git(directory, "cat-file", "--batch", input=("\n".join(shas) + "\n").encode())
+    blobs = {}
+    position = 0
+    while output and position < len(output):
+        header_end = output.index(b'\n', position)
+        header = output[position:header_end].split()
+        position = header_end + 1
+        if len(header) < 3 or header[1] == b'missing':
+            continue
+        size = int(header[2])
+        blobs[header[0].decode()] = output[position:position + size]
+        position += size + 1
+    return blobs
+
+
+def head_blobs(directory):
+    """
+    Returns (path, sha, size) for every blob in the HEAD commit, with paths relative to the repository root.
+    Paths are NUL-separated so core.quotePath doesn't escape non-ASCII names.
+    """
+    tree = git(directory, "ls-tree", "-r", "-l", "-z", "--full-tree", "HEAD") or b""
+    blobs = []
+    for entry in tree.split(b'\0'):
+        if not entry:
+            continue
+        meta, path = entry.split(b'\t', 1)
+        _, kind, sha, size = meta.split()
+        if kind == b'blob':
+            blobs.append((os.fsdecode(path), sha.decode(), int(size)))
+    return blobs
+
+
+def _read_batches(shas, sizes):
+    """
+    Splits shas into lists whose blobs add up to about READ_BATCH_BYTES each.
+    """
+    batch = []
+    batch_bytes = 0
+    for sha in shas:
+        if batch and batch_bytes + sizes[sha] > READ_BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(sha)
+        batch_bytes += sizes[sha]
+    if batch:
+        yield batch
+
+
+def decode_source(path, data):
+    """
+    Returns a blob as text, or None if it is too large, binary or generated to be worth indexing.
+    """
+    if len(data) > MAX_BLOB_BYTES or filetypes.classify_content(path, data):
+        return None
+    return data.decode('utf-8', errors='replace')
+
+
+def _prune_indexes(index_dir):
+    """
+    Deletes all but the MAX_INDEXES most recently written indexes in a directory.
+    """
+    paths = sorted(glob.glob(os.path.join(index_dir, "*.json")), key=os.path.getmtime)
+    for path in paths[:-MAX_INDEXES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_index(directory, name, version, extract):
+    """
+    Returns a {path: {"sha", "data"}} index of the HEAD commit, where data is extract(path, text) for each source blob.
+    The index is stored on disk per commit. Building one for a new commit reuses the data of every blob whose SHA is
+    unchanged since the most recent index, so only blobs touched by the commits in between are read and extracted.
+    """
+    head = head_commit(directory)
+    if not head:
+        return None
+    if (name, head) in _loaded:
+        return _loaded[(name, head)]
+
+    toplevel = (git(directory, "rev-parse", "--show-toplevel") or b"").strip()
+    index_dir = cache.get_cache_dir('index', hashlib.sha1(toplevel).hexdigest()[:16], name)
+    index_path = os.path.join(index_dir, f"{head}.json")
+
+    def read_index(path):
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            return stored["files"] if stored.get("version") == version else None
+        except (OSError, ValueError, KeyError):
+            return None
+
+    files = read_index(index_path) if os.path.exists(index_path) else None
+    if files is None:
+        previous_paths = sorted(glob.glob(os.path.join(index_dir, "*.json")), key=os.path.getmtime)
+        previous = (read_index(previous_paths[-1]) if previous_paths else None) or {}
+        reused_by_sha = {entry["sha"]: entry["data"] for entry in previous.values()}
+
+        files = {}
+        to_read = {}
+        sizes = {}
+        for path, sha, size in head_blobs(directory):
+            if filetypes.classify_name(path):
+                continue
+            if sha in reused_by_sha:
+                files[path] = {"sha": sha, "data": reused_by_sha[sha]}
+            elif size > MAX_BLOB_BYTES:
+                # Too large to index, and never read. Stored with no data like other skipped blobs
+                files[path] = {"sha": sha, "data": None}
+            else:
+                to_read.setdefault(sha, []).append(path)
+                sizes[sha] = size
+        print(f"Updating {name} index: {sum(len(p) for p in to_read.values())} changed blobs, {len(files)} reused or too large")
+        for batch in _read_batches(list(to_read), sizes):
+            blobs = read_blobs(directory, batch)
+            for sha in batch:
+                for path in to_read[sha]:
+                    text = decode_source(path, blobs.get(sha, b""))
+                    # Skipped blobs are stored with no data so the next index doesn't read them again
+                    files[path] = {"sha": sha, "data": extract(path, text) if text is not None else None}
+
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": version, "commit": head, "files": files}, f)
+        os.replace(tmp_path, index_path)
+        _prune_indexes(index_dir)
+
+    _loaded[(name, head)] = files
+    return files
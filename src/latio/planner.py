@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import time
+try:
+    from . import cache
+    from . import tokens
+except ImportError:
+    import cache
+    import tokens
+
+# Paths that tend to hold authentication, input handling, secrets and infrastructure, scanned right after changed files
+high_risk_patterns = re.compile(
+    r'(auth|login|session|passw|token|secret|credential|crypt|key|oauth|jwt|permission|admin|'
+    r'api|route|controller|view|handler|endpoint|upload|download|exec|shell|command|query|sql|db|'
+    r'serializ|pickle|template|config|settings|docker|k8s|kube|helm|terraform|\.tf$|iam|policy)',
+    re.IGNORECASE,
+)
+
+# Used until there is history for a model: a fixed overhead per request plus time per thousand input tokens
+DEFAULT_REQUEST_SECONDS = 5.0
+DEFAULT_SECONDS_PER_1K_TOKENS = 0.5
+MAX_TIMING_HISTORY = 50
+
+# Files are grouped into requests of roughly this many tokens so the planner can stop between requests
+DEFAULT_BATCH_TOKENS = 30000
+
+
+def parse_deadline(value):
+    """
+    Parses a deadline like "120s", "2m", "1h" or "90" into seconds.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*', value)
+    if not match:
+        raise ValueError(f"Invalid deadline '{value}', expected a duration like 120s, 2m or 1h")
+    number, unit = float(match.group(1)), match.group(2)
+    return number * {'': 1, 's': 1, 'm': 60, 'h': 3600}[unit]
+
+
+def new_budget(deadline=None, max_tokens=None, mode="full"):
+    """
+    Returns the state tracked while a planned scan runs. deadline is in seconds from now.
+    mode names the kind of request being timed, since a single review and a multi-step agent run take very different times.
+    """
+    return {
+        "mode": mode,
+        "start": time.monotonic(),
+        "deadline": deadline,
+        "max_tokens": max_tokens,
+        "spent_tokens": 0,
+        "requests": 0,
+        "scanned_files": [],
+        "skipped_files": [],
+        "stop_reason": None,
+    }
+
+
+def prioritize_files(directory, files, changed_files=()):
+    """
+    Returns files ordered by scan priority: locally changed files, then high-risk paths, then everything else.
+    The order within each group is kept, so the plan is deterministic.
+    """
+    changed = {os.path.normpath(f) for f in changed_files}
+
+    def priority(file_path):
+        relative = os.path.normpath(os.path.relpath(file_path, directory))
+        if relative in changed:
+            return 0
+        if high_risk_patterns.search(relative):
+            return 1
+        return 2
+
+    return sorted(files, key=priority)
+
+
+def plan_batches(files, batch_tokens=DEFAULT_BATCH_TOKENS):
+    """
+    Groups prioritized files into (files, estimated_tokens) batches of about batch_tokens each, keeping priority order.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for file_path in files:
+        try:
+            file_tokens = tokens.tokens_for_chars(os.path.getsize(file_path))
+        except OSError:
+            continue
+        if current and current_tokens + file_tokens > batch_tokens:
+            batches.append((current, current_tokens))
+            current = []
+            current_tokens = 0
+        current.append(file_path)
+        current_tokens += file_tokens
+    if current:
+        batches.append((current, current_tokens))
+    return batches
+
+
+def _load_timings(model, mode):
+    """
+    Returns the recorded (tokens, seconds) history for a model in a scan mode.
+    """
+    cached = cache.read_cached('timings', mode, f"{model}.json")
+    if cached is None:
+        return []
+    try:
+        return json.loads(cached)
+    except ValueError:
+        return []
+
+
+def estimate_seconds(model, request_tokens, mode="full"):
+    """
+    Estimates how long a request of request_tokens will take, from this model's past requests in the mode when there are any.
+    """
+    history = _load_timings(model, mode)
+    if not history:
+        return DEFAULT_REQUEST_SECONDS + DEFAULT_SECONDS_PER_1K_TOKENS * request_tokens / 1000
+    total_tokens = sum(t for t, _ in history) or 1
+    total_seconds = sum(s for _, s in history)
+    return max(total_seconds / total_tokens * request_tokens, min(s for _, s in history))
+
+
+def remaining_seconds(budget):
+    """
+    Returns the seconds left before the deadline, or None if there is no deadline.
+    """
+    if budget["deadline"] is None:
+        return None
+    return budget["deadline"] - (time.monotonic() - budget["start"])
+
+
+def should_stop(budget, model, request_tokens):
+    """
+    Returns the reason not to start a request of request_tokens, or None if it fits in the remaining budget.
+    """
+    if budget["max_tokens"] is not None and budget["spent_tokens"] + request_tokens > budget["max_tokens"]:
+        return f"token budget of {budget['max_tokens']} would be exceeded"
+    remaining = remaining_seconds(budget)
+    if remaining is not None and estimate_seconds(model, request_tokens, budget["mode"]) > remaining:
+        return f"deadline of {budget['deadline']:g}s would be exceeded"
+    return None
+
+
+def record_request(budget, model, files, request_tokens, seconds, used_tokens=None):
+    """
+    Records a successful request in the budget and in the model's timing history for the scan mode.
+    Failed requests go to skip_files instead, so their files aren't counted as scanned and their fast failures
+    don't make later estimates too optimistic.
+    The history is kept in planned tokens so estimates stay comparable, used_tokens is what the provider actually reported.
+    """
+    budget["spent_tokens"] += request_tokens if used_tokens is None else used_tokens
+    budget["requests"] += 1
+    budget["scanned_files"].extend(files)
+    history = _load_timings(model, budget["mode"])[-(MAX_TIMING_HISTORY - 1):]
+    history.append([request_tokens, seconds])
+    cache.write_cached(json.dumps(history), 'timings', budget["mode"], f"{model}.json")
+
+
+def skip_files(budget, files, reason):
+    """
+    Marks files as not scanned and records the first reason the plan had to leave work out.
+    """
+    budget["skipped_files"].extend(files)
+    if budget["stop_reason"] is None:
+        budget["stop_reason"] = reason
+
+
+def coverage_report(budget, directory, max_listed=20):
+    """
+    Returns a short report of what the planned scan covered and what it had to leave out.
+    """
+    scanned = len(budget["scanned_files"])
+    total = scanned + len(budget["skipped_files"])
+    elapsed = time.monotonic() - budget["start"]
+    report = f"Coverage: scanned {scanned} of {total} files ({scanned / total if total else 1:.0%}) in {budget['requests']} requests"
+    report += f", ~{budget['spent_tokens']} tokens"
+    if budget["max_tokens"] is not None:
+        report += f" of {budget['max_tokens']}"
+    report += f", {elapsed:.1f}s"
+    if budget["deadline"] is not None:
+        report += f" of {budget['deadline']:g}s"
+    if budget["stop_reason"]:
+        report += f"\nLeft work out because the {budget['stop_reason']}"
+    if budget["skipped_files"]:
+        listed = [os.path.relpath(f, directory) for f in budget["skipped_files"][:max_listed]]
+        more = len(budget["skipped_files"]) - len(listed)
+        report += "\nNot scanned: " + ", ".join(listed) + (f" and {more} more" if more > 0 else "")
+    return report
@@ -0,0 +1,155 @@
+import os
+import subprocess
+from collections import Counter
+try:
+    from . import cache
+    from . import tokens
+except ImportError:
+    import cache
+    import tokens
+
+# Every prompt is laid out as system prompt, then repository context, then the task and code to review.
+# The system prompt is shared by every scan mode and the repository context only changes per commit, so
+# security and health passes, and repeated runs on the same commit, all start with a byte-identical
+# prefix that provider-side prompt caching can reuse. Nothing that changes per run may go above the task.
+SYSTEM_PROMPT = (
+    "You are an application security expert and a world class 10x developer, skilled in explaining complex "
+    "programming vulnerabilities and code smells with simplicity, and in giving kind, specific suggestions for fixing them. "
+    "You will first receive context about the repository being reviewed, then a review task, then the code to review. "
+    "Changed code is shown as unified diff hunks: lines starting with + are being added and lines starting with - are being removed. "
+    "Suggest specific code fixes where applicable, with an example based on the user's code."
+)
+
+full_security_task = (
+    "Task: You will receive the full code for an application. Review the code for security vulnerabilities and suggest improvements. "
+    "Don't overly focus on one file, and instead provide the top security concerns based on what you think the entire application is doing."
+)
+
+full_health_task = (
+    "Task: You will receive the full code for an application. Review the code for optimizations and improvements, calling out the major bottlenecks "
+    "and optimizing for big O complexity. Don't overly focus on one file, and instead provide the best optimizations based on what you think "
+    "the entire application is doing."
+)
+
+partial_security_task = (
+    "Task: You will receive changed code as part of a pull request, followed by the rest of the file. Review the code change for security "
+    "vulnerabilities and suggest improvements. Focus the most on the code that is being changed, which starts with Detailed Line Changes, "
+    "instead of Changed Files."
+)
+
+partial_health_task = (
+    "Task: You will receive changed code as part of a pull request, followed by the rest of the file. Review the changed code for optimizations "
+    "and improvements, calling out any potential slowdowns. Focus the most on the code that is being changed, which starts with Detailed Line "
+    "Changes, instead of Changed Files."
+)
+
+# Appended to the task when findings are streamed as NDJSON or SARIF, so each response can be parsed as it arrives
+findings_format = (
+    " Respond with only a JSON object of the form {\"findings\": [{\"file\": path, \"start_line\": number, \"end_line\": number, "
+    "\"severity\": \"critical\" | \"high\" | \"medium\" | \"low\" | \"info\", \"rule\": short-kebab-case-id, \"message\": text}]}. "
+    "Use the file paths exactly as they appear in the code you receive and line numbers from the new version of the file. "
+    "Put the explanation and the suggested fix in the message. Return an empty findings list if there are no issues."
+)
+
+# Limits that keep the repository context block small enough to send on every call
+MAX_CONTEXT_DIRECTORIES = 40
+MAX_CONTEXT_EXTENSIONS = 15
+MAX_README_CHARS = 3000
+README_NAMES = ("README.md", "README.rst", "README.txt", "README")
+# OpenAI only caches prompts of at least 1024 tokens, so tracked paths are listed until the system prompt and
+# repository context together reach this estimate. Repositories with too few paths stay below it and won't cache.
+CACHE_PREFIX_TOKENS = 1200
+# Bumped whenever the layout of the context block changes, so blocks cached by older versions aren't reused
+CONTEXT_VERSION = 2
+
+
+def _git(directory, *args):
+    """
+    Returns the output of a git command run in the directory, or None if it fails.
+    """
+    try:
+        return subprocess.check_output(["git", *args], cwd=directory, text=True, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def repository_context(directory):
+    """
+    Returns a repository context block that is byte-identical for every call on the same commit.
+    It is built only from committed content (tracked files and the committed README), so local edits don't change it,
+    and is cached on disk per commit. Returns an empty string outside a git repository.
+    """
+    head = _git(directory, "rev-parse", "HEAD")
+    if not head:
+        return ""
+    head = head.strip()
+    cached = cache.read_cached('context', f"v{CONTEXT_VERSION}-{head}")
+    if cached is not None:
+        return cached
+
+    tracked = (_git(directory, "ls-tree", "-r", "--name-only", "HEAD") or "").splitlines()
+    readme = find_readme(tracked)
+    readme_text = (_git(directory, "show", f"HEAD:{readme}") or "") if readme else ""
+    context = format_repository_context(head, tracked, readme, readme_text)
+    cache.write_cached(context, 'context', f"v{CONTEXT_VERSION}-{head}")
+    return context
+
+
+def find_readme(paths):
+    """
+    Returns the top-level README among the paths, or None if there isn't one.
+    """
+    for readme in README_NAMES:
+        if readme in paths:
+            return readme
+    return None
+
+
+def format_repository_context(commit, tracked, readme=None, readme_text="", repository=None):
+    """
+    Returns the repository context block for a commit from its tracked paths and README.
+    Ends with as many tracked paths, in sorted order, as it takes for the stable prefix to reach CACHE_PREFIX_TOKENS.
+    """
+    directories = Counter(path.split('/', 1)[0] if '/' in path else '.' for path in tracked)
+    extensions = Counter(os.path.splitext(path)[1] or os.path.basename(path) for path in tracked)
+
+    context = "Repository context:\n"
+    if repository:
+        context += f"Repository: {repository}\n"
+    context += f"Commit: {commit}\n"
+    context += f"Tracked files: {len(tracked)}\n"
+    context += "Top-level directories (files): " + ", ".join(
+        f"{name} ({count})" for name, count in sorted(directories.items())[:MAX_CONTEXT_DIRECTORIES]) + "\n"
+    context += "File types (files): " + ", ".join(
+        f"{name} ({count})" for name, count in sorted(extensions.items(), key=lambda item: (-item[1], item[0]))[:MAX_CONTEXT_EXTENSIONS]) + "\n"
+    if readme:
+        context += f"\n{readme}:\n{readme_text[:MAX_README_CHARS]}\n"
+
+    missing_chars = (CACHE_PREFIX_TOKENS - tokens.estimate_tokens(SYSTEM_PROMPT + "\n\n" + context)) * tokens.CHARS_PER_TOKEN
+    if missing_chars > 0 and tracked:
+        listed = []
+        for path in sorted(tracked):
+            if missing_chars <= 0:
+                break
+            listed.append(path)
+            missing_chars -= len(path) + 1
+        context += "\nTracked paths" + (f" (first {len(listed)})" if len(listed) < len(tracked) else "") + ":\n" + "\n".join(listed) + "\n"
+    return context
+
+
+def build_messages(task, payload, repo_context=""):
+    """
+    Returns chat messages in stable-prefix order: system prompt, repository context, then the task and code.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if repo_context:
+        messages.append({"role": "user", "content": repo_context})
+    messages.append({"role": "user", "content": task + "\n\nHere is the code:\n" + payload})
+    return messages
+
+
+def build_prompt(task, payload, repo_context=""):
+    """
+    Returns the same layout as build_messages as a single string, for models that take one prompt.
+    """
+    return "\n\n".join(message["content"] for message in build_messages(task, payload, repo_context))
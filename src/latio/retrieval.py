@@ -0,0 +1,168 @@
+import math
+import re
+from collections import Counter
+try:
+    from . import gitindex
+    from . import tokens
+except ImportError:
+    import gitindex
+    import tokens
+
+# Each file is indexed as windows of this many lines, which is also the size of a returned snippet
+WINDOW_LINES = 40
+INDEX_VERSION = 2
+
+# BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+
+DEFAULT_RELATED_TOKENS = 4000
+MAX_SNIPPETS = 10
+
+identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+camel_case_part = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+# Keywords and names that appear everywhere and say nothing about what code is related
+stopwords = {
+    'and', 'any', 'are', 'as', 'async', 'await', 'bool', 'break', 'case', 'catch', 'char', 'class', 'const',
+    'continue', 'def', 'default', 'del', 'do', 'elif', 'else', 'end', 'enum', 'except', 'export', 'extends',
+    'false', 'final', 'finally', 'float', 'fn', 'for', 'from', 'func', 'function', 'get', 'go', 'if', 'impl',
+    'import', 'in', 'int', 'interface', 'is', 'let', 'long', 'mut', 'new', 'nil', 'none', 'not', 'null', 'object',
+    'or', 'package', 'pass', 'private', 'protected', 'pub', 'public', 'raise', 'return', 'self', 'set', 'static',
+    'str', 'string', 'struct', 'super', 'switch', 'the', 'this', 'throw', 'throws', 'true', 'try', 'type', 'use',
+    'var', 'void', 'while', 'with', 'yield',
+}
+
+# Inverted indexes already built in this process, keyed by commit
+_loaded_indexes = {}
+
+
+def tokenize(text):
+    """
+    Returns the search terms in text: every identifier, plus its snake_case and camelCase parts.
+    """
+    terms = []
+    for name in identifier.findall(text):
+        lowered = name.lower()
+        if len(lowered) >= 3 and lowered not in stopwords:
+            terms.append(lowered)
+        parts = [part.lower() for piece in name.split('_') for part in camel_case_part.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) >= 3 and part not in stopwords)
+    return terms
+
+
+def _index_source(path, text):
+    """
+    Returns the windows of a file as [start_line, end_line, {term: count}] lists.
+    """
+    lines = text.splitlines()
+    docs = []
+    for start in range(0, len(lines), WINDOW_LINES):
+        window = lines[start:start + WINDOW_LINES]
+        terms = Counter(tokenize("\n".join(window)))
+        if terms:
+            docs.append([start + 1, start + len(window), dict(terms)])
+    return docs
+
+
+def build_index(directory):
+    """
+    Returns the BM25 index for the repository's HEAD commit.
+    The per-file windows are stored per commit by gitindex, so only blobs changed since the last index are tokenized.
+    """
+    head = gitindex.head_commit(directory)
+    if not head:
+        return None
+    if head not in _loaded_indexes:
+        files = gitindex.load_index(directory, 'bm25', INDEX_VERSION, _index_source)
+        _loaded_indexes[head] = _invert(files or {})
+    return _loaded_indexes[head]
+
+
+def _invert(files):
+    """
+    Returns the in-memory inverted index for per-file windows.
+    """
+    docs = []
+    postings = {}
+    for path in sorted(files):
+        entry = files[path]
+        for start, end, terms in entry["data"] or []:
+            doc_id = len(docs)
+            docs.append({"path": path, "sha": entry["sha"], "start": start, "end": end, "length": sum(terms.values())})
+            for term, count in terms.items():
+                postings.setdefault(term, []).append((doc_id, count))
+    average_length = sum(doc["length"] for doc in docs) / len(docs) if docs else 0
+    return {"docs": docs, "postings": postings, "average_length": average_length}
+
+
+def search(index, query_terms, exclude_paths=(), limit=MAX_SNIPPETS):
+    """
+    Returns up to limit (score, doc) pairs ranked by BM25 for the query terms, skipping excluded paths.
+    """
+    docs = index["docs"]
+    if not docs:
+        return []
+    exclude = set(exclude_paths)
+    scores = Counter()
+    for term, query_count in Counter(query_terms).items():
+        postings = index["postings"].get(term)
+        if not postings:
+            continue
+        idf = math.log((len(docs) - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+        for doc_id, count in postings:
+            length_norm = 1 - B + B * docs[doc_id]["length"] / index["average_length"]
+            scores[doc_id] += query_count * idf * count * (K1 + 1) / (count + K1 * length_norm)
+    ranked = []
+    for doc_id, score in scores.most_common():
+        if docs[doc_id]["path"] in exclude:
+            continue
+        ranked.append((score, docs[doc_id]))
+        if len(ranked) >= limit:
+            break
+    return ranked
+
+
+def query_terms_for_diffs(file_diffs):
+    """
+    Returns the search terms for the symbols touched by a diff: added and removed lines, and the function names in hunk headers.
+    """
+    terms = []
+    for file_diff in file_diffs:
+        for hunk in file_diff["hunks"]:
+            if hunk["header"]:
+                # Git puts the enclosing function after the second @@
+                terms.extend(tokenize(hunk["header"].split('@@')[-1]))
+            for line in hunk["lines"]:
+                if line.startswith(('+', '-')) or file_diff["status"] == "full":
+                    terms.extend(tokenize(line))
+    return terms
+
+
+def related_code(directory, file_diffs, max_tokens=DEFAULT_RELATED_TOKENS):
+    """
+    Returns the code snippets most related to a diff, formatted for the payload and capped at max_tokens.
+    Snippets from the changed files themselves are left out, the diff already covers them.
+    """
+    if max_tokens <= 0 or not file_diffs:
+        return ""
+    index = build_index(directory)
+    if not index:
+        return ""
+    ranked = search(index, query_terms_for_diffs(file_diffs), exclude_paths=[d["file"] for d in file_diffs])
+    blobs = gitindex.read_blobs(directory, list({doc["sha"] for _, doc in ranked}))
+
+    output = ""
+    used_tokens = 0
+    for _, doc in ranked:
+        lines = blobs.get(doc["sha"], b"").decode('utf-8', errors='replace').splitlines()
+        snippet = f"\nFile: {doc['path']} (lines {doc['start']}-{doc['end']})\n" + "\n".join(lines[doc["start"] - 1:doc["end"]]) + "\n"
+        snippet_tokens = tokens.estimate_tokens(snippet)
+        if used_tokens + snippet_tokens > max_tokens:
+            continue
+        output += snippet
+        used_tokens += snippet_tokens
+    if output:
+        print(f"Added {used_tokens} tokens of related code")
+    return output
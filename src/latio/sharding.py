@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+try:
+    from . import findings
+except ImportError:
+    import findings
+
+REPORT_VERSION = 1
+
+shard_strategies = ['hash', 'size']
+
+
+def parse_shard(spec):
+    """
+    Parses a shard spec like "2/4" into a 1-based (index, count) tuple.
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}', expected <index>/<count> like 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{spec}', index must be between 1 and {max(count, 1)}")
+    return index, count
+
+
+def _path_bucket(relative_path, count):
+    """
+    Returns the 0-based shard a path belongs to. Uses sha1 rather than hash() so every machine agrees.
+    """
+    digest = hashlib.sha1(relative_path.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def _size_buckets(directory, file_paths, count):
+    """
+    Returns a path -> 0-based shard mapping that balances total bytes across shards.
+    Files are placed largest first onto the lightest shard, with ties broken by path so the result is deterministic.
+    """
+    sized = []
+    for file_path in file_paths:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        sized.append((size, os.path.relpath(file_path, directory), file_path))
+    sized.sort(key=lambda item: (-item[0], item[1]))
+
+    totals = [0] * count
+    buckets = {}
+    for size, _, file_path in sized:
+        bucket = min(range(count), key=lambda b: (totals[b], b))
+        totals[bucket] += size
+        buckets[file_path] = bucket
+    return buckets
+
+
+def select_shard(directory, file_paths, shard, strategy='hash'):
+    """
+    Returns the subset of file_paths that belongs to the given (index, count) shard.
+    Every shard of the same inventory is disjoint and together they cover every file.
+    """
+    index, count = shard
+    if strategy == 'size':
+        buckets = _size_buckets(directory, file_paths, count)
+        selected = [f for f in file_paths if buckets[f] == index - 1]
+    elif strategy == 'hash':
+        selected = [f for f in file_paths if _path_bucket(os.path.relpath(f, directory), count) == index - 1]
+    else:
+        raise ValueError(f"Unknown shard strategy '{strategy}', use one of {', '.join(shard_strategies)}")
+    print(f"Shard {index}/{count} ({strategy}): {len(selected)} of {len(file_paths)} files")
+    return selected
+
+
+def default_report_path(mode, shard):
+    """
+    Returns the file name a shard report is written to when no --report path is given.
+    """
+    index, count = shard
+    return f"latio-{mode}-shard-{index}-of-{count}.json"
+
+
+def write_shard_report(report_path, mode, directory, shard, strategy, files, result, model, health=False, structured_findings=None):
+    """
+    Writes the machine-readable partial report for a single shard.
+    structured_findings are the findings streamed with --format, or None when the scan only produced text.
+    """
+    index, count = shard
+    report = {
+        "version": REPORT_VERSION,
+        "mode": mode,
+        "health": health,
+        "model": model,
+        "shard": {"index": index, "count": count, "strategy": strategy},
+        "files": sorted(os.path.relpath(f, directory) for f in files),
+        "result": result,
+        "findings": structured_findings,
+    }
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote shard report to {report_path}")
+    return report
+
+
+def merge_shard_reports(report_paths):
+    """
+    Combines shard reports into one report, keeping the last report when a shard appears more than once.
+    Text results are kept in shard order as written. Structured findings are deduplicated by (file, start_line, rule),
+    keeping the first, since a finding can be reported again by another batch or shard that saw the same code.
+    Raises ValueError if the reports come from different scans or were split with different strategies.
+    """
+    reports = {}
+    first = None
+    for report_path in report_paths:
+        with open(report_path) as f:
+            report = json.load(f)
+        if report.get("version") != REPORT_VERSION:
+            raise ValueError(f"{report_path} is not a latio shard report")
+        if first is None:
+            first = report
+        elif (report["mode"], report["health"], report["shard"]["count"], report["shard"]["strategy"]) != (first["mode"], first["health"], first["shard"]["count"], first["shard"]["strategy"]):
+            raise ValueError(f"{report_path} is from a different scan than {report_paths[0]}")
+        index = report["shard"]["index"]
+        if index in reports:
+            print(f"Warning: shard {index} appears more than once, keeping {report_path}")
+        reports[index] = report
+
+    if first is None:
+        raise ValueError("No shard reports to merge")
+
+    count = first["shard"]["count"]
+    missing = [i for i in range(1, count + 1) if i not in reports]
+    if missing:
+        print(f"Warning: missing shards {', '.join(str(i) for i in missing)} of {count}")
+
+    files = set()
+    results = []
+    merged_findings = None
+    seen = set()
+    for index in sorted(reports):
+        files.update(reports[index]["files"])
+        if reports[index]["result"]:
+            results.append(reports[index]["result"])
+        # Reports from text scans, and from before findings were recorded, have no findings
+        if reports[index].get("findings") is None:
+            continue
+        merged_findings = merged_findings or []
+        for finding in reports[index]["findings"]:
+            key = (finding["file"], finding["start_line"], finding["rule"])
+            if key not in seen:
+                seen.add(key)
+                merged_findings.append(finding)
+
+    return {
+        "version": REPORT_VERSION,
+        "mode": first["mode"],
+        "health": first["health"],
+        "model": first["model"],
+        "shards": {"merged": sorted(reports), "missing": missing, "count": count},
+        "files": sorted(files),
+        "results": results,
+        "findings": merged_findings,
+    }
+
+
+def format_merged_report(merged):
+    """
+    Returns a merged report as the markdown printed at the end of a scan.
+    """
+    shards = merged["shards"]
+    output = f"Merged {len(shards['merged'])} of {shards['count']} shards covering {len(merged['files'])} files\n"
+    if shards["missing"]:
+        output += f"Missing shards: {', '.join(str(i) for i in shards['missing'])}\n"
+    if merged["findings"] is not None:
+        output += f"{len(merged['findings'])} unique findings:\n" + "".join(findings.format_finding(finding) + "\n" for finding in merged["findings"]) + "\n"
+    output += "\n\n".join(merged["results"])
+    return output
@@ -0,0 +1,16 @@
+# Common rule of thumb for English text and source code with OpenAI and Gemini tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def tokens_for_chars(char_count):
+    """
+    Returns a rough token count for the given number of characters.
+    """
+    return (char_count + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_tokens(text):
+    """
+    Returns a rough token count for a payload, using the common estimate of four characters per token.
+    """
+    return tokens_for_chars(len(text))
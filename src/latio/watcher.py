@@ -0,0 +1,163 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+DEFAULT_DEBOUNCE = 1.0
+POLL_INTERVAL = 1.0
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _walk(directory, ignore):
+    """
+    Yields (root, files) for every directory under the given one that isn't ignored.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not ignore(os.path.join(root, d)))
+        yield root, [f for f in files if not ignore(os.path.join(root, f))]
+
+
+def _load_inotify():
+    """
+    Returns libc if it provides inotify, otherwise None so the watcher falls back to polling.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _inotify_events(directory, ignore, libc, timeout=POLL_INTERVAL):
+    """
+    Yields the relative paths of changed files as inotify reports them, or None after timeout seconds with no events.
+    Raises OSError if the watches can't be set up, for example when the user's inotify watch limit is reached.
+    """
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    watches = {}
+
+    def add_watches(top):
+        for root, _ in _walk(top, ignore):
+            wd = libc.inotify_add_watch(fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"inotify_add_watch failed for {root}: {os.strerror(errno)}")
+            watches[wd] = root
+
+    try:
+        add_watches(directory)
+        while True:
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if not readable:
+                yield None
+                continue
+            data = os.read(fd, 65536)
+            position = 0
+            while position < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, position)
+                name = data[position + EVENT_HEADER.size:position + EVENT_HEADER.size + length].rstrip(b'\0')
+                position += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped, so any file may have changed
+                    yield ''
+                    continue
+                if wd not in watches or not name:
+                    continue
+                path = os.path.join(watches[wd], os.fsdecode(name))
+                if ignore(path):
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            add_watches(path)
+                        except OSError as e:
+                            print(f"Warning: not watching new directory {path}: {e}")
+                    continue
+                yield os.path.relpath(path, directory)
+    finally:
+        os.close(fd)
+
+
+def _snapshot(directory, ignore):
+    """
+    Returns {relative path: (mtime, size)} for every file that isn't ignored.
+    """
+    state = {}
+    for root, files in _walk(directory, ignore):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[os.path.relpath(path, directory)] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+def _polling_events(directory, ignore):
+    """
+    Yields the relative paths of files whose mtime or size changed between polls, or None after a quiet poll.
+    """
+    previous = _snapshot(directory, ignore)
+    while True:
+        time.sleep(POLL_INTERVAL)
+        current = _snapshot(directory, ignore)
+        changed = [path for path in set(previous) | set(current) if previous.get(path) != current.get(path)]
+        previous = current
+        if not changed:
+            yield None
+        for path in sorted(changed):
+            yield path
+
+
+def watch_changes(directory, ignore=lambda path: False, debounce=DEFAULT_DEBOUNCE):
+    """
+    Yields sets of relative paths that changed under the directory, once no more changes arrive for debounce seconds.
+    An empty string in the set means events were lost and every file should be treated as changed.
+    Uses inotify on Linux and falls back to polling file modification times elsewhere.
+    """
+    libc = _load_inotify()
+    events = None
+    if libc is not None:
+        try:
+            # Wake up at least once per debounce period, so short debounces aren't stretched to the poll interval
+            events = _inotify_events(directory, ignore, libc, timeout=min(POLL_INTERVAL, debounce))
+            # Set up the watches now so a failure falls back to polling before anything is reported
+            pending = {next(events)} - {None}
+            print("Watching for changes with inotify")
+        except OSError as e:
+            print(f"Warning: could not watch with inotify ({e}), polling for changes instead")
+            events = None
+    if events is None:
+        events = _polling_events(directory, ignore)
+        pending = set()
+        print(f"Watching for changes every {POLL_INTERVAL:g}s")
+
+    last_event = time.monotonic()
+    for path in events:
+        now = time.monotonic()
+        if path is not None:
+            pending.add(path)
+            last_event = now
+        if pending and now - last_event >= debounce:
+            yield pending
+            pending = set()
@@ -5,9 +5,19 @@ from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
 import subprocess
 import os
 from typing import List, Dict, Set
+try:
+    from . import prompts
+    from . import filetypes
+except ImportError:
+    import prompts
+    import filetypes
+
+# Every agent's instructions start with the same text so that agent calls, including agents
+# called as tools, share a cacheable prefix. Agent-specific instructions always come after it.
+AGENT_PREFIX = RECOMMENDED_PROMPT_PREFIX + "\n\n" + prompts.SYSTEM_PROMPT + "\n\n"
 
 @function_tool
-def analyze_code_context(function_changes: List[str], changed_files: List[str]) -> dict[str, str]:
+async def analyze_code_context(function_changes: List[str], changed_files: List[str]) -> str:
     """
     Takes in a list of files and line changes and returns any relevant file details and application context.
     """
@@ -24,8 +34,12 @@ def analyze_code_context(function_changes: List[str], changed_files: List[str])
             clean_file = file.lstrip('./')
             # Construct absolute path for the file
             file_path = os.path.join(workspace_root, clean_file)
-            with open(file_path, 'r') as f:
-                file_contents[file] = f.read()
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(file_path)
+            # Binaries and generated files are skipped before they are decoded
+            content = filetypes.read_text_file(file_path)
+            if content is not None:
+                file_contents[file] = content
         except FileNotFoundError:
             print(f"Warning: File {file_path} not found")
         except Exception as e:
@@ -34,13 +48,16 @@ def analyze_code_context(function_changes: List[str], changed_files: List[str])
     # Get the codebase info by searching the codebase for any .md files
     codebase_info = ""
     try:
-        for root, _, files in os.walk(workspace_root):
-            for file in files:
+        for root, dirs, files in os.walk(workspace_root):
+            # Walk in sorted order so the docs come out byte-identical on every call
+            dirs.sort()
+            for file in sorted(files):
                 if file.endswith(".md"):
                     file_path = os.path.join(root, file)
                     try:
-                        with open(file_path, 'r') as f:
-                            codebase_info += f.read() + "\n"
+                        content = filetypes.read_text_file(file_path)
+                        if content is not None:
+                            codebase_info += content + "\n"
                     except Exception as e:
                         print(f"Warning: Error reading markdown file {file_path}: {str(e)}")
     except Exception as e:
@@ -48,10 +65,12 @@ def analyze_code_context(function_changes: List[str], changed_files: List[str])
 
     app_context_agent = Agent(
         name="App Context Agent",
-        ),
-    context_info_prompt = "You are a developer with a deep understanding of the codebase and the latest best practices. You will receive information about a codebase, changed functions, and file details. Your job is to summarize the application context, including the overall purpose of the application, the overall architecture, and the overall codebase. Here is some information about the codebase and what it's doing: " + str(codebase_info) + "\n Here is the file contents: " + str(file_contents) + "\n Here is the function changes: " + str(function_changes)
-    app_context = Runner.run(app_context_agent, context_info_prompt)
-    return app_context
+        instructions=AGENT_PREFIX + "You are a developer with a deep understanding of the codebase and the latest best practices. You will receive information about a codebase, changed functions, and file details. Your job is to summarize the application context, including the overall purpose of the application, the overall architecture, and the overall codebase.",
+    )
+    # The markdown docs only change between commits, so they go before the changed files and functions
+    context_info_prompt = "Here is some information about the codebase and what it's doing: " + str(codebase_info) + "\n Here is the file contents: " + str(file_contents) + "\n Here is the function changes: " + str(function_changes)
+    app_context = await Runner.run(app_context_agent, context_info_prompt)
+    return app_context.final_output
 
 @function_tool
 def gather_full_code(changed_files: List[str]):
@@ -73,12 +92,17 @@ def gather_full_code(changed_files: List[str]):
             clean_file = file.lstrip('./')
             # Construct absolute path for the file
             file_path = os.path.join(workspace_root, clean_file)
-            with open(file_path, 'r') as f:
-                # Read lines and add line numbers
-                print(f"Reading file: {file_path}")
-                lines = f.readlines()
-                numbered_lines = [f"{i+1}: {line}" for i, line in enumerate(lines)]
-                file_contents[file] = ''.join(numbered_lines)
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(file_path)
+            # Binaries and generated files are skipped before they are decoded
+            content = filetypes.read_text_file(file_path)
+            if content is None:
+                continue
+            # Add line numbers
+            print(f"Reading file: {file_path}")
+            lines = content.splitlines(keepends=True)
+            numbered_lines = [f"{i+1}: {line}" for i, line in enumerate(lines)]
+            file_contents[file] = ''.join(numbered_lines)
         except FileNotFoundError:
             print(f"Warning: File {file_path} not found")
         except Exception as e:
@@ -89,9 +113,8 @@ def gather_full_code(changed_files: List[str]):
 security_agent = Agent(
     name="Security Agent",
     handoff_description="Specialist in evaluating code for security issues.",
-    instructions=(
+    instructions=AGENT_PREFIX + (
     """
-    {RECOMMENDED_PROMPT_PREFIX}
     You are a super friendly security expert with a deep understanding of the codebase and the latest security best practices.
     You will be given a list of files and code snippets to evaluate for security issues, as well as additional context about the codebase.
     Give the user a short summary of the security issues you found, the files they were found in, the lines of code that are affected, and some fix guidance with an example specific to the user's code.
@@ -102,7 +125,7 @@ security_agent = Agent(
 health_agent = Agent(
     name="Health Agent",
     handoff_description="Specialist in evaluating code for health issues.",
-    instructions=(
+    instructions=AGENT_PREFIX + (
     "You are a 10x developer with a deep understanding of the codebase and the latest health best practices."
     "You will be given a list of files and code snippets to evaluate for health issues, as well as additional context about the codebase    ."
     "Give the user a short summary of the health issues you found, the files they were found in, the lines of code that are affected, and some fix guidance with an example."
@@ -112,7 +135,7 @@ health_agent = Agent(
 context_agent = Agent(
     name="Context Agent",
     handoff_description="Specialist in evaluating code for security and health issues.",
-    instructions=(
+    instructions=AGENT_PREFIX + (
     "You are a coding expert with a deep understanding of the codebase and the latest security and health best practices."
     "You will be given a list of files and lines of code that have been changed in a pull request. You will first find all relevant code and files related to the changes."
     "The analyze_code_context function takes in a list of function changes based on the line changes you're seeing, as well as their file paths, and returns a summary of the relevant code and files."
@@ -130,8 +153,7 @@ context_agent = Agent(
 full_context_agent_code = Agent(
     name="Full Context Agent Code Gatherer",
     handoff_description="Specialist in evaluating code for security and health issues.",
-    instructions=("""
-    {RECOMMENDED_PROMPT_PREFIX}
+    instructions=AGENT_PREFIX + ("""
     You are a coding expert with a deep understanding of the codebase and the latest security and health best practices."
     You will be given a list of files for analysis. You will first fetch all of the code for these files using the analyze_code_context function."
     This will be a lot of information to process, so condense this information for the security and health agents: what the application is generally doing, what the files are doing in the context of the application, and the specific lines of code that are most relevant for analysis."
@@ -147,8 +169,7 @@ full_context_agent_code = Agent(
 full_context_file_parser = Agent(
     name="Full Context Agent File Parser",
     handoff_description="Specialist in evaluating code for security and health issues.",
-    instructions=("""
-    {RECOMMENDED_PROMPT_PREFIX}
+    instructions=AGENT_PREFIX + ("""
     You are a coding expert with a deep understanding of the codebase and the latest security and health best practices.
     You are going to receive a list of files with number of characters, return only the ones that seem the most relevant for security or health analysis.
     Then, you will make sure to drop any files that seem they will be larger than your context window, which is about 512,000 characters.
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# The OpenAI client is created at import time and refuses to start without a key
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from latio import core, tokens
+
+DIFF = """diff --git a/app.py b/app.py
+index 3b18e51..a9c2f4d 100644
+--- a/app.py
++++ b/app.py
+@@ -1,6 +1,7 @@ def handler(request):
+ import os
+-password = os.environ.get("PASSWORD")
++password = os.environ["PASSWORD"]
++token = request.args.get("token")
+ def check(user):
+-    return user.password == password
++    return hmac.compare_digest(user.password, password)
+ 
+"""
+
+
+def test_plain_diff_has_no_ansi_codes():
+    file_diffs = [{"file": "app.py", "status": "modified", "hunks": core.parse_diff_hunks(DIFF)}]
+    plain = core.format_file_diffs(file_diffs)
+    assert '\x1b[' not in plain
+    assert '+token = request.args.get("token")' in plain
+    assert '@@ -1,6 +1,7 @@ def handler(request):' in plain
+    assert 'index 3b18e51' not in plain
+
+
+def legacy_payload(diff, file):
+    """
+    Returns the payload partial_scan used to send: the raw git diff with its headers, every added or removed line
+    wrapped in ANSI colors, and the whole block wrapped in green.
+    """
+    def color_line(line):
+        if line.startswith('+'):
+            return core.color_text(line, "32")
+        if line.startswith('-'):
+            return core.color_text(line, "31")
+        return line
+    payload = f"\nFile: {core.color_text(file, '34')}\n" + "".join(color_line(line) + "\n" for line in diff.splitlines())
+    return core.color_text(payload, "32")
+
+
+def test_plain_diff_uses_fewer_tokens_than_legacy_payload():
+    file_diffs = [{"file": "app.py", "status": "modified", "hunks": core.parse_diff_hunks(DIFF)}]
+    plain = core.format_file_diffs(file_diffs)
+    legacy = legacy_payload(DIFF, "app.py")
+    # The same changed lines are sent, without the git headers and escape codes
+    assert tokens.estimate_tokens(plain) <= 0.75 * tokens.estimate_tokens(legacy)